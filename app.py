@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
 import time
 import datetime
@@ -8,10 +9,24 @@ import json
 import os
 import socket
 import sqlite3
+import threading
+import contextlib
+import collections
+import functools
+import bisect
+import unicodedata
 import altair as alt
 from oauth2client.service_account import ServiceAccountCredentials
 from PIL import Image
 import base64
+import xlsxwriter
+import openpyxl
+import hashlib
+import hmac
+import secrets
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import shutil
+import zipfile
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
@@ -131,13 +146,80 @@ STUDENT_STATUSES = ["Active", "Transferred", "Dropped Out", "Graduate", "Deleted
 
 # --- DATA MANAGER ---
 
-@st.cache_data(ttl=30, show_spinner=False)
+class ConnectivityMonitor:
+    """Tracks whether the cloud is reachable without blocking page renders.
+    A background thread probes the network; Sheets API calls report their outcome, and after
+    FAILURE_THRESHOLD consecutive failures the circuit opens (Local mode) until COOLDOWN_SECONDS
+    have passed, when a single trial call is let through; its outcome closes or re-opens the circuit."""
+    PROBE_SECONDS = 15
+    PROBE_TIMEOUT = 2.0
+    FAILURE_THRESHOLD = 3
+    COOLDOWN_SECONDS = 60
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        # The first probe is synchronous: startup work (migrations, worksheet creation) must see the real mode.
+        self.reachable = self._probe()
+        threading.Thread(target=self._run, name="sgs-connectivity", daemon=True).start()
+
+    def _probe(self):
+        try:
+            socket.create_connection(("8.8.8.8", 53), timeout=self.PROBE_TIMEOUT).close()
+            return True
+        except OSError:
+            return False
+
+    def _closed(self):
+        return self.reachable and self.opened_at is None
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.PROBE_SECONDS)
+            self._wake.clear()
+            was_up = self._closed()
+            self.reachable = self._probe()
+            if self._closed() and not was_up:
+                try: get_sync_worker().notify()
+                except Exception: pass
+
+    def is_up(self):
+        if not self.reachable: return False
+        with self._lock:
+            if self.opened_at is None: return True
+            # Half-open: one caller gets the trial; a trial whose outcome is never recorded is re-offered after another cooldown.
+            now = time.time()
+            if now - max(self.opened_at, self.trial_at or 0) < self.COOLDOWN_SECONDS: return False
+            self.trial_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures, self.opened_at, self.trial_at, self.last_error = 0, None, None, None
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error) if error else None
+            if self.failures >= self.FAILURE_THRESHOLD: self.opened_at, self.trial_at = time.time(), None
+        self._wake.set()
+
+@st.cache_resource
+def get_connectivity_monitor():
+    return ConnectivityMonitor()
+
 def is_online():
-    try:
-        socket.create_connection(("8.8.8.8", 53), timeout=1.0)
-        return True
-    except OSError:
-        return False
+    return get_connectivity_monitor().is_up()
+
+def cloud_call_succeeded():
+    get_connectivity_monitor().record_success()
+
+def cloud_call_failed(error=None):
+    get_connectivity_monitor().record_failure(error)
 
 def get_data_mode():
     if is_online(): return 'Cloud'
@@ -157,125 +239,1120 @@ def get_cloud_connection():
         print(f"Cloud Error: {e}")
         return None
 
+# --- LOCAL CONNECTION POOL ---
+class LocalDB:
+    """Process-wide pool of SQLite connections in WAL mode.
+    Readers borrow any idle connection; writers are serialized by one lock so they never hit SQLITE_BUSY."""
+    PRAGMAS = [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=10000",
+    ]
+
+    def __init__(self, path, max_idle=8):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        for pragma in self.PRAGMAS: conn.execute(pragma)
+        return conn
+
+    @contextlib.contextmanager
+    def connect(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None: conn = self._open()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction: conn.rollback()
+            with self._lock:
+                if len(self._idle) < self.max_idle: self._idle.append(conn); conn = None
+            if conn is not None: conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._write_lock, self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+
+@st.cache_resource
+def get_db():
+    return LocalDB(LOCAL_DB)
+
+# --- LOCAL SCHEMA ---
+# Key column per table: the SQLite primary key and the match column for keyed writes.
+TABLE_KEYS = {
+    "Users": "username",
+    "Subjects": "id",
+    "Students": "student_id",
+    "Grades": "id",
+    "Config": "uid",
+    "Attendance": "uid",
+    "Assessments": "assessment_id",
+    "TaskScores": "uid",
+    "Credentials": "principal",
+    "Blobs": "blob_hash",
+}
+
+DB_SCHEMA = {
+    "Users": [("username", "TEXT NOT NULL COLLATE NOCASE"), ("password", "TEXT"), ("role", "TEXT"), ("profile_pic", "TEXT")],
+    "Subjects": [("id", "INTEGER NOT NULL"), ("teacher_username", "TEXT"), ("subject_name", "TEXT")],
+    "Students": [("student_id", "TEXT NOT NULL"), ("student_name", "TEXT"), ("class_no", "INTEGER"), ("grade_level", "TEXT"), ("room", "TEXT"), ("photo", "TEXT"), ("password", "TEXT"), ("status", "TEXT")],
+    "Grades": [("id", "INTEGER NOT NULL"), ("student_id", "TEXT"), ("subject", "TEXT"), ("quarter", "TEXT"), ("school_year", "TEXT"), ("test1", "REAL"), ("test2", "REAL"), ("test3", "REAL"), ("final_score", "REAL"), ("total_score", "REAL"), ("recorded_by", "TEXT"), ("timestamp", "TEXT")],
+    "Config": [("uid", "TEXT NOT NULL"), ("subject", "TEXT"), ("quarter", "TEXT"), ("year", "TEXT"), ("test_name", "TEXT"), ("task_name", "TEXT"), ("max_score", "REAL"), ("assessment_id", "TEXT"), ("task_no", "INTEGER")],
+    "Attendance": [("uid", "TEXT NOT NULL"), ("student_id", "TEXT"), ("student_name", "TEXT"), ("subject", "TEXT"), ("date", "TEXT"), ("status", "TEXT"), ("recorded_by", "TEXT"), ("timestamp", "TEXT")],
+    # One row per test of a subject/quarter/year; TaskScores holds one row per student per task of it.
+    "Assessments": [("assessment_id", "TEXT NOT NULL"), ("subject", "TEXT"), ("quarter", "TEXT"), ("school_year", "TEXT"), ("test_name", "TEXT")],
+    "TaskScores": [("uid", "TEXT NOT NULL"), ("student_id", "TEXT"), ("assessment_id", "TEXT"), ("task_no", "INTEGER"), ("score", "REAL")],
+    # Salted password hashes keyed by "staff:<username lowercased>" / "student:<student_id>"; the password columns stay blank.
+    "Credentials": [("principal", "TEXT NOT NULL"), ("password_hash", "TEXT")],
+    # Images stored once by content hash; Students.photo / Users.profile_pic hold "sha256:<blob_hash>".
+    "Blobs": [("blob_hash", "TEXT NOT NULL"), ("mime", "TEXT"), ("data", "TEXT")],
+}
+# Change tracking: epoch seconds of the last write, stamped locally and pushed with the row.
+for _cols in DB_SCHEMA.values(): _cols.append(("updated_at", "REAL"))
+
+DB_INDEXES = {
+    "idx_grades_class": ("Grades", ["subject", "quarter", "school_year"]),
+    "idx_grades_student": ("Grades", ["student_id"]),
+    "idx_config_test": ("Config", ["subject", "quarter", "year", "test_name"]),
+    "idx_config_assessment": ("Config", ["assessment_id", "task_no"]),
+    "idx_assessments_class": ("Assessments", ["subject", "quarter", "school_year"]),
+    "idx_taskscores_assessment": ("TaskScores", ["assessment_id", "student_id"]),
+    "idx_taskscores_student": ("TaskScores", ["student_id"]),
+    "idx_attendance_subject": ("Attendance", ["subject", "date"]),
+    "idx_attendance_student_subject": ("Attendance", ["student_id", "subject"]),
+    "idx_students_class": ("Students", ["grade_level", "room"]),
+    "idx_subjects_teacher": ("Subjects", ["teacher_username"]),
+}
+
+# Local-only tables derived from the synced ones: maintained by every local write, never given a worksheet.
+DERIVED_SCHEMA = {
+    # One row per student, subject and school year: quarter totals, semester totals with GPA, year average.
+    "GradeSummary": [("student_id", "TEXT NOT NULL"), ("subject", "TEXT NOT NULL"), ("school_year", "TEXT NOT NULL"), ("teacher", "TEXT"),
+                     ("Q1", "REAL"), ("Q2", "REAL"), ("Q3", "REAL"), ("Q4", "REAL"), ("sem1_total", "REAL"), ("sem1_gpa", "REAL"),
+                     ("sem2_total", "REAL"), ("sem2_gpa", "REAL"), ("year_avg", "REAL")],
+    # Running dashboard counts, e.g. ("students_status", "Active") -> 412.
+    "DashboardCounters": [("counter", "TEXT NOT NULL"), ("bucket", "TEXT NOT NULL"), ("value", "INTEGER")],
+    # Grades rows per subject and student; a subject's student count moves when a pair appears or disappears.
+    "SubjectStudents": [("subject", "TEXT NOT NULL"), ("student_id", "TEXT NOT NULL"), ("grade_rows", "INTEGER")],
+    # Running attendance totals per student and subject: each row counts every status on or before its date.
+    "AttendanceTotals": [("student_id", "TEXT NOT NULL"), ("subject", "TEXT NOT NULL"), ("date", "TEXT NOT NULL"),
+                         ("Present", "INTEGER"), ("Late", "INTEGER"), ("Absent", "INTEGER"), ("Excused", "INTEGER")],
+}
+ATTENDANCE_STATUSES = ["Present", "Late", "Absent", "Excused"]
+
+# Columns holding student ids; stored normalized (no trailing ".0") so lookups are exact matches.
+ID_COLUMNS = {"student_id"}
+
+def table_columns(table_name):
+    return [c for c, _ in DB_SCHEMA.get(table_name) or DERIVED_SCHEMA[table_name]]
+
+# Hand-edited sheets may head a schema column differently; rows are renamed to the schema's names as they are loaded.
+COLUMN_ALIASES = {
+    "student_id": ["Student ID", "StudentID", "ID"],
+    "student_name": ["Student Name", "Name"],
+    "subject": ["Subject Name"],
+    "status": ["Attendance"],
+    "date": ["Day"],
+    "recorded_by": ["Teacher", "Recorded By"],
+}
+
+def _fold_header(h):
+    return str(h).strip().lower().replace(" ", "_")
+
+def _alias_target(sheet_name, header):
+    """The schema column of sheet_name that header spells (in any case or spacing), or None."""
+    folded, cols = _fold_header(header), table_columns(sheet_name)
+    return next((c for c in cols if folded == _fold_header(c)), None) or \
+           next((c for c in cols if folded in map(_fold_header, COLUMN_ALIASES.get(c, []))), None)
+
+@functools.lru_cache(maxsize=None)
+def canonical_headers(sheet_name, headers):
+    """headers (a tuple) with every alias of a schema column replaced by that column's name."""
+    return tuple(_alias_target(sheet_name, h) or h for h in headers)
+
+def normalize_columns(sheet_name, rows):
+    """rows keyed by schema column names. The mapping is resolved once per distinct header set; where a sheet
+    carries both a column and an alias of it, the first non-empty value wins."""
+    out, last, names = [], None, None
+    for r in rows:
+        keys = tuple(r)
+        if keys != last: last, names = keys, canonical_headers(sheet_name, keys)
+        if names == keys:
+            out.append(r)
+            continue
+        row = {}
+        for name, v in zip(names, r.values()):
+            if row.get(name, "") == "": row[name] = v
+        out.append(row)
+    return out
+
+def _upgrade_legacy_rows(sheet_name, rows):
+    """Config rows written before assessments existed get the assessment_id/task_no _migrate_v4 derives for local rows."""
+    if sheet_name != "Config": return rows
+    out = []
+    for r in rows:
+        if r.get("assessment_id") in (None, ""): r = dict(r, assessment_id=assessment_key(r.get("subject"), r.get("quarter"), r.get("year"), r.get("test_name")))
+        if r.get("task_no") in (None, ""): r = dict(r, task_no=task_no_of(r.get("task_name")))
+        out.append(r)
+    return out
+
+def sheet_rows(sheet_name, rows):
+    """Rows read from a worksheet, in the local schema: aliased headers renamed, legacy rows upgraded."""
+    return _upgrade_legacy_rows(sheet_name, normalize_columns(sheet_name, rows))
+
+def _table_exists(conn, table_name):
+    return conn.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()[0] > 0
+
+def _create_table(conn, table_name, extra_cols=()):
+    cols = [f'"{c}" {t}' for c, t in DB_SCHEMA[table_name]] + [f'"{c}"' for c in extra_cols]
+    conn.execute(f'CREATE TABLE "{table_name}" (' + ", ".join(cols) + f', PRIMARY KEY ("{TABLE_KEYS[table_name]}"))')
+
+def _create_indexes(conn):
+    for name, (table_name, cols) in DB_INDEXES.items():
+        if _table_exists(conn, table_name):
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table_name}" (' + ", ".join(f'"{c}"' for c in cols) + ")")
+
+def _rebuild_table(conn, table_name):
+    """Copies a legacy untyped table into the declared schema, keeping the last row per key."""
+    if not _table_exists(conn, table_name):
+        _create_table(conn, table_name)
+        if table_name == "Users" and bootstrap_admin_allowed():
+            conn.execute("INSERT INTO Users (username, password, role, profile_pic) VALUES ('admin', 'admin123', 'Admin', '')")
+        return
+    old_cols = _local_columns(conn, table_name)
+    # Colliding legacy ids are re-keyed locally only; the sheet's copies are re-keyed (and pushed) by the first full pull.
+    rows, _ = _rekey_duplicates(table_name, [dict(zip(old_cols, r)) for r in conn.execute(f'SELECT * FROM "{table_name}"')])
+    conn.execute(f'ALTER TABLE "{table_name}" RENAME TO "_old_{table_name}"')
+    _create_table(conn, table_name, [c for c in old_cols if c not in table_columns(table_name)])
+    _local_replace(conn, table_name, rows)
+    conn.execute(f'DROP TABLE "_old_{table_name}"')
+
+def spreadsheet_configured():
+    """Whether this install syncs with a spreadsheet at all (gcp secrets present), reachable or not."""
+    try: return "gcp" in st.secrets
+    except Exception: return False
+
+def bootstrap_admin_allowed():
+    """Whether a fresh local DB may seed admin/admin123: only for an install without a spreadsheet, or when the
+    spreadsheet has no admin yet. With a spreadsheet that is unreachable or already has one, the real
+    credentials arrive with the first sync and nothing is seeded."""
+    if not spreadsheet_configured(): return True
+    sh = get_cloud_connection() if is_online() else None
+    if not sh: return False
+    try: return not any(str(r.get("role")) == "Admin" for r in sh.worksheet("Users").get_all_records())
+    except gspread.exceptions.WorksheetNotFound: return True
+    except Exception: return False
+
+def _migrate_v1(conn):
+    for table_name in DB_SCHEMA: _rebuild_table(conn, table_name)
+    _create_indexes(conn)
+
+def _migrate_v2(conn):
+    # Durable write-behind queue: one row per changed key; row_key NULL means "push the whole table".
+    conn.execute("""CREATE TABLE IF NOT EXISTS SyncOutbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, sheet_name TEXT NOT NULL, row_key TEXT,
+        queued_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL DEFAULT 0, last_error TEXT)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_sheet ON SyncOutbox (sheet_name, next_attempt_at)")
+
+def _migrate_v3(conn):
+    for table_name in DB_SCHEMA:
+        if _table_exists(conn, table_name) and "updated_at" not in _local_columns(conn, table_name):
+            conn.execute(f'ALTER TABLE "{table_name}" ADD COLUMN "updated_at" REAL')
+    conn.execute("CREATE TABLE IF NOT EXISTS SyncState (sheet_name TEXT PRIMARY KEY, watermark REAL NOT NULL, synced_at REAL NOT NULL)")
+
+def _migrate_v4(conn):
+    # Task scores move from the fixed t1..t10 columns of Tasks to one TaskScores row per task.
+    # Nothing is queued: cloud Config rows are upgraded as they are read and the cloud Tasks sheet is converted
+    # by convert_cloud_tasks, so pushing this copy could only overwrite newer rows from other servers.
+    for table_name in ("Assessments", "TaskScores"):
+        if not _table_exists(conn, table_name): _create_table(conn, table_name)
+    for col, col_type in DB_SCHEMA["Config"]:
+        if col not in _local_columns(conn, "Config"): conn.execute(f'ALTER TABLE Config ADD COLUMN "{col}" {col_type}')
+    _create_indexes(conn)
+    now = round(time.time(), 3)
+    configs = conn.execute("SELECT uid, subject, quarter, year, test_name, task_name FROM Config WHERE assessment_id IS NULL").fetchall()
+    conn.executemany("UPDATE Config SET assessment_id = ?, task_no = ?, updated_at = ? WHERE uid = ?",
+                     [(assessment_key(sub, q, yr, t), task_no_of(tn), now, uid) for uid, sub, q, yr, t, tn in configs])
+    if not _table_exists(conn, "Tasks"): return
+    cols = _local_columns(conn, "Tasks")
+    tests, scores = _legacy_task_scores([dict(zip(cols, r)) for r in conn.execute("SELECT * FROM Tasks")], now)
+    if tests:
+        _local_upsert(conn, "Assessments", list(tests.values()))
+        _local_upsert(conn, "TaskScores", scores)
+    conn.execute("DROP TABLE Tasks")
+
+def _legacy_task_scores(rows, now):
+    """Legacy Tasks rows (fixed t1..t10 columns) as ({assessment_id: Assessments row}, [TaskScores rows])."""
+    tests, scores = {}, []
+    for r in rows:
+        aid = assessment_key(r.get("subject"), r.get("quarter"), r.get("school_year"), r.get("test_name"))
+        tests[aid] = {"assessment_id": aid, "subject": r.get("subject"), "quarter": r.get("quarter"), "school_year": r.get("school_year"), "test_name": r.get("test_name"), "updated_at": now}
+        sid = norm_key(r.get("student_id"))
+        task_vals = {i: _as_float(r.get(f"t{i}")) for i in range(1, 11) if _as_float(r.get(f"t{i}"))}
+        # Final Exam rows only ever carried raw_total; keep it as task 1.
+        if not task_vals and _as_float(r.get("raw_total")): task_vals = {1: _as_float(r.get("raw_total"))}
+        scores += [{"uid": task_score_key(sid, aid, n), "student_id": sid, "assessment_id": aid, "task_no": n, "score": v, "updated_at": now} for n, v in task_vals.items()]
+    return tests, scores
+
+def _migrate_v5(conn):
+    # Plaintext passwords move to salted hashes in Credentials.
+    if not _table_exists(conn, "Credentials"): _create_table(conn, "Credentials")
+    now = round(time.time(), 3)
+    creds, pushed = [], []
+    for table_name, key, principal in (("Users", "username", staff_principal), ("Students", "student_id", student_principal)):
+        plain = conn.execute(f'SELECT "{key}", password FROM "{table_name}" WHERE password IS NOT NULL AND password != \'\'').fetchall()
+        for k, pw in plain:
+            creds.append({"principal": principal(k), "password_hash": hash_password(norm_key(pw)), "updated_at": now})
+            # The admin123 seed is hashed locally only, so it can never overwrite a changed cloud admin password.
+            if not (table_name == "Users" and k == "admin" and pw == "admin123"): pushed.append((table_name, k, principal(k)))
+        conn.execute(f'UPDATE "{table_name}" SET password = \'\', updated_at = ? WHERE password IS NOT NULL AND password != \'\'', (now,))
+    if creds: _local_upsert(conn, "Credentials", creds)
+    # The worker holds the blanked Users/Students rows back until these Credentials rows are on the sheet.
+    if pushed: enqueue_sync(conn, "Credentials", [p for _, _, p in pushed])
+    for table_name in ("Users", "Students"):
+        keys = [k for t, k, _ in pushed if t == table_name]
+        if keys: enqueue_sync(conn, table_name, keys)
+
+def _migrate_v6(conn):
+    # Inline base64 photos move to Blobs; the photo columns keep only a reference.
+    if not _table_exists(conn, "Blobs"): _create_table(conn, "Blobs")
+    now = round(time.time(), 3)
+    blobs = {}
+    for table_name, key, col in (("Users", "username", "profile_pic"), ("Students", "student_id", "photo")):
+        inline = conn.execute(f'SELECT "{key}", "{col}" FROM "{table_name}" WHERE "{col}" IS NOT NULL AND "{col}" != \'\' AND "{col}" NOT LIKE \'{BLOB_PREFIX}%\'').fetchall()
+        updates = []
+        for k, b64 in inline:
+            data = base64_to_image(b64)
+            if not data: continue
+            blob_hash = hashlib.sha256(data).hexdigest()
+            blobs[blob_hash] = {"blob_hash": blob_hash, "mime": "image/jpeg", "data": b64, "updated_at": now}
+            updates.append((BLOB_PREFIX + blob_hash, now, k))
+        conn.executemany(f'UPDATE "{table_name}" SET "{col}" = ?, updated_at = ? WHERE "{key}" = ?', updates)
+        if updates: enqueue_sync(conn, table_name, [u[2] for u in updates])
+    if blobs:
+        _local_upsert(conn, "Blobs", list(blobs.values()))
+        enqueue_sync(conn, "Blobs", list(blobs))
+
+def _migrate_v7(conn):
+    cols = ", ".join(f'"{c}" {t}' for c, t in DERIVED_SCHEMA["GradeSummary"])
+    conn.execute(f"CREATE TABLE IF NOT EXISTS GradeSummary ({cols}, PRIMARY KEY (student_id, subject, school_year))")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_summary_class ON GradeSummary (subject, school_year)")
+    refresh_grade_summary(conn)
+
+def _migrate_v8(conn):
+    for table_name, pk in (("DashboardCounters", "counter, bucket"), ("SubjectStudents", "subject, student_id")):
+        cols = ", ".join(f'"{c}" {t}' for c, t in DERIVED_SCHEMA[table_name])
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({cols}, PRIMARY KEY ({pk}))")
+    for table_name in COUNTED_TABLES: recount_dashboard(conn, table_name)
+
+def _migrate_v9(conn):
+    # (student_id, subject) also serves the student_id-only lookups the old index was for.
+    conn.execute("DROP INDEX IF EXISTS idx_attendance_student")
+    _create_indexes(conn)
+
+def _migrate_v10(conn):
+    cols = ", ".join(f'"{c}" {t}' for c, t in DERIVED_SCHEMA["AttendanceTotals"])
+    conn.execute(f"CREATE TABLE IF NOT EXISTS AttendanceTotals ({cols}, PRIMARY KEY (student_id, subject, date))")
+    rebuild_attendance_totals(conn)
+
+def _migrate_v11(conn):
+    # Columns pulled under an alias before loads were normalized are folded into their schema column.
+    folded = False
+    for t in DB_SCHEMA:
+        if not _table_exists(conn, t): continue
+        for col in _local_columns(conn, t):
+            target = _alias_target(t, col)
+            if target in (None, col): continue
+            conn.execute(f'UPDATE "{t}" SET "{target}" = "{col}" WHERE COALESCE("{target}", \'\') = \'\'')
+            conn.execute(f'ALTER TABLE "{t}" DROP COLUMN "{col}"')
+            folded = True
+    if folded:
+        refresh_grade_summary(conn)
+        for t in COUNTED_TABLES: recount_dashboard(conn, t)
+        rebuild_attendance_totals(conn)
+
+def _migrate_v12(conn):
+    # A bootstrap admin123 credential hashed locally by v5 must not outlive a spreadsheet that has its own admin.
+    if bootstrap_admin_allowed(): return
+    row = conn.execute("SELECT password_hash FROM Credentials WHERE principal = ?", (staff_principal("admin"),)).fetchone()
+    queued = conn.execute("SELECT 1 FROM SyncOutbox WHERE sheet_name = 'Credentials' AND (row_key = ? OR row_key IS NULL)", (staff_principal("admin"),)).fetchone()
+    if row and not queued and verify_password("admin123", row[0]): _local_delete(conn, "Credentials", [staff_principal("admin")])
+
+# MIGRATIONS[n] upgrades a database from PRAGMA user_version n to n + 1.
+MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4, _migrate_v5, _migrate_v6, _migrate_v7, _migrate_v8, _migrate_v9, _migrate_v10, _migrate_v11, _migrate_v12]
+
+def migrate_db(db):
+    with db.connect() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for v in range(version, len(MIGRATIONS)):
+        try:
+            with db.transaction() as conn:
+                MIGRATIONS[v](conn)
+                conn.execute(f"PRAGMA user_version = {v + 1}")
+        except Exception as e:
+            # Running on a half-migrated schema would corrupt data; nothing is served until this is fixed.
+            st.error(f"Database upgrade to version {v + 1} failed: {e}")
+            st.stop()
+            return
+
 @st.cache_resource
 def init_db():
-    conn = sqlite3.connect(LOCAL_DB)
-    tables = {
-        "Users": ["username", "password", "role", "profile_pic"],
-        "Subjects": ["id", "teacher_username", "subject_name"],
-        "Students": ["student_id", "student_name", "class_no", "grade_level", "room", "photo", "password", "status"],
-        "Grades": ["id", "student_id", "subject", "quarter", "school_year", "test1", "test2", "test3", "final_score", "total_score", "recorded_by", "timestamp"],
-        "Config": ["uid", "subject", "quarter", "year", "test_name", "task_name", "max_score"],
-        "Attendance": ["uid", "student_id", "student_name", "subject", "date", "status", "recorded_by", "timestamp"]
-    }
-    task_cols = ["uid", "student_id", "subject", "quarter", "school_year", "test_name"]
-    for i in range(1, 11): task_cols.append(f"t{i}") 
-    task_cols.append("raw_total")
-    tables["Tasks"] = task_cols
-
-    for table_name, columns in tables.items():
-        query = f"SELECT count(name) FROM sqlite_master WHERE type='table' AND name='{table_name}'"
-        cursor = conn.execute(query)
-        if cursor.fetchone()[0] == 0:
-            if table_name == "Users":
-                df = pd.DataFrame([["admin", "admin123", "Admin", ""]], columns=columns)
-            else:
-                df = pd.DataFrame(columns=columns)
-            df.to_sql(table_name, conn, index=False)
+    migrate_db(get_db())
             
     if get_data_mode() == 'Cloud':
         try:
             sh = get_cloud_connection()
             if sh:
                 titles = [w.title for w in sh.worksheets()]
-                for t in tables.keys():
-                    if t not in titles:
-                        ws = sh.add_worksheet(t, 100, len(tables[t]))
-                        ws.append_row(tables[t])
-                        if t == "Users": ws.append_row(["admin", "admin123", "Admin", ""])
-        except: pass
-    conn.close()
-
-@st.cache_data(ttl=60)
+                for t in DB_SCHEMA:
+                    if t not in titles: ensure_worksheet(sh, t, titles)
+                if LEGACY_TASKS_SHEET in titles: convert_cloud_tasks(sh)
+        except Exception as e: print(f"Worksheet Setup Error: {e}")
+
+LEGACY_TASKS_SHEET = "Tasks"
+
+def convert_cloud_tasks(sh):
+    """Converts the legacy Tasks worksheet into Assessments/TaskScores, as _migrate_v4 does for the local table,
+    then renames it so it is converted once. Scores already on the TaskScores sheet are kept."""
+    ws = sh.worksheet(LEGACY_TASKS_SHEET)
+    tests, scores = _legacy_task_scores(ws.get_all_records(), round(time.time(), 3))
+    existing = {norm_key(r.get("uid")) for r in ensure_worksheet(sh, "TaskScores").get_all_records()}
+    scores = [r for r in scores if norm_key(r["uid"]) not in existing]
+    with get_db().transaction() as conn:
+        if tests:
+            _local_upsert(conn, "Assessments", list(tests.values()))
+            enqueue_sync(conn, "Assessments", list(tests))
+        if scores:
+            _local_upsert(conn, "TaskScores", scores)
+            enqueue_sync(conn, "TaskScores", [r["uid"] for r in scores])
+    ws.update_title(f"{LEGACY_TASKS_SHEET} (converted)")
+    invalidate_tables("Assessments", "TaskScores")
+
+def ensure_worksheet(sh, sheet_name, titles=None):
+    """The table's worksheet, created with its header row when the spreadsheet lacks it. Not cached, so a
+    worksheet missing at startup (or deleted later) is created by whichever call first needs it."""
+    try: return sh.worksheet(sheet_name)
+    except gspread.exceptions.WorksheetNotFound: pass
+    if titles is None: titles = [w.title for w in sh.worksheets()]
+    ws = sh.add_worksheet(sheet_name, 100, len(DB_SCHEMA[sheet_name]))
+    ws.append_row(table_columns(sheet_name))
+    if sheet_name == "Users": ws.append_row(["admin", "", "Admin", ""])
+    # Only a brand-new spreadsheet gets the bootstrap admin credential.
+    if sheet_name == "Credentials" and "Users" not in titles: ws.append_row([staff_principal("admin"), hash_password("admin123")])
+    return ws
+
+# --- TABLE CACHE ---
+class TableCache:
+    """Process-wide read cache partitioned by table. Every table has a version counter; a write bumps
+    only the versions of the tables it touched, so cached reads of other tables stay warm."""
+    TTL = 60          # cloud reads may be stale by other servers' edits, local reads only by our own writes
+    MAX_ENTRIES = 512
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.versions = collections.Counter()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        # Versions restart at 0 with the process; anything keyed on them outside memory also keys on this.
+        self.epoch = secrets.token_hex(8)
+        self.mode = None
+
+    def get(self, table, key, loader, ttl=None):
+        with self._lock:
+            entry = self._entries.get((table, key))
+            if entry and entry[0] == self.versions[table] and entry[1] > time.time():
+                self._entries.move_to_end((table, key))
+                self.hits[table] += 1
+                return entry[2]
+            self.misses[table] += 1
+            version = self.versions[table]
+        value = loader()
+        with self._lock:
+            # A write that landed while loading makes this result stale; serve it once but don't keep it.
+            if version == self.versions[table]:
+                self._entries[(table, key)] = (version, time.time() + (ttl or float("inf")), value)
+                while len(self._entries) > self.MAX_ENTRIES: self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, *tables):
+        with self._lock:
+            for t in tables: self.versions[t] += 1
+            for k in [k for k in self._entries if k[0] in tables]: del self._entries[k]
+
+    def follow_mode(self, mode):
+        """Drops every entry when the data mode changes: reads cached in Local mode never expire by TTL."""
+        with self._lock:
+            if mode == self.mode: return
+            self.mode = mode
+            for t, _ in self._entries: self.versions[t] += 1
+            self._entries.clear()
+
+    def stats(self):
+        """{table: (hits, misses, version)}"""
+        with self._lock:
+            tables = set(self.hits) | set(self.misses) | set(self.versions)
+            return {t: (self.hits[t], self.misses[t], self.versions[t]) for t in sorted(tables)}
+
+@st.cache_resource
+def get_table_cache():
+    return TableCache()
+
+# Cached reads derived from other tables' rows: a write to the source also invalidates them.
+DERIVED_FROM = {"Grades": ["GradeSummary", "DashboardCounters"], "Config": ["GradeSummary"], "Attendance": ["AttendanceTotals"],
+                "Users": ["DashboardCounters"], "Subjects": ["DashboardCounters"], "Students": ["DashboardCounters", "StudentSearch"]}
+
+def invalidate_tables(*tables):
+    get_table_cache().invalidate(*tables, *[d for t in tables for d in DERIVED_FROM.get(t, [])])
+
+def cached_read(table, key, loader):
+    """get_table_cache().get under the current data mode: Local reads are kept until a write, Cloud reads for the TTL."""
+    mode, cache = get_data_mode(), get_table_cache()
+    cache.follow_mode(mode)
+    return cache.get(table, key, loader, None if mode == 'Local' else TableCache.TTL)
+
+def _cached_rows(sheet_name, key, loader):
+    # Callers edit the returned dicts in place before saving, so each one gets its own copies.
+    return [dict(r) for r in cached_read(sheet_name, key, loader)]
+
+def _read_local(sheet_name, where="", params=()):
+    with get_db().connect() as conn:
+        df = pd.read_sql(f'SELECT * FROM "{sheet_name}"' + where, conn, params=list(params))
+    cols_to_str = ['student_id', 'password', 'username', 'teacher_username', 'ID']
+    for col in cols_to_str:
+        if col in df.columns:
+            df[col] = df[col].astype(str).str.strip().str.replace(r'\.0$', '', regex=True).replace('nan', '')
+    return df.fillna("").to_dict('records')
+
 def fetch_all_records(sheet_name):
+    return _cached_rows(sheet_name, (), lambda: _load_all_records(sheet_name))
+
+def _load_all_records(sheet_name):
     mode = get_data_mode()
     if mode == 'Local':
-        try:
-            conn = sqlite3.connect(LOCAL_DB)
-            df = pd.read_sql(f"SELECT * FROM {sheet_name}", conn)
-            conn.close()
-            cols_to_str = ['student_id', 'password', 'username', 'teacher_username', 'ID']
-            for col in cols_to_str:
-                if col in df.columns:
-                    df[col] = df[col].astype(str).str.strip().str.replace(r'\.0$', '', regex=True).replace('nan', '')
-            return df.fillna("").to_dict('records')
+        try: return _read_local(sheet_name)
         except: return []
     elif mode == 'Cloud':
+        # Unsynced local edits are newer than the sheet, so serve this table locally until they are pushed.
+        if has_pending_sync(sheet_name):
+            try: return _read_local(sheet_name)
+            except: return []
         for attempt in range(3):
             try:
                 sh = get_cloud_connection()
                 if not sh: return fetch_all_records_local_fallback(sheet_name)
-                return sh.worksheet(sheet_name).get_all_records()
-            except gspread.exceptions.WorksheetNotFound: 
-                init_db(); time.sleep(1); continue
-            except gspread.exceptions.APIError: time.sleep(1); continue
-            except Exception: return []
+                data = sheet_rows(sheet_name, ensure_worksheet(sh, sheet_name).get_all_records())
+                cloud_call_succeeded()
+                return data
+            except gspread.exceptions.APIError as e: cloud_call_failed(e); time.sleep(1); continue
+            except Exception as e:
+                cloud_call_failed(e)
+                return fetch_all_records_local_fallback(sheet_name)
+        return fetch_all_records_local_fallback(sheet_name)
     return []
 
+class Between(collections.namedtuple("Between", "low high")):
+    """fetch_records filter value matching low <= value <= high as text (ISO dates compare in order); None leaves that end open."""
+    def matches(self, val):
+        val = str(val)
+        return (self.low is None or val >= str(self.low)) and (self.high is None or val <= str(self.high))
+
+def _filter_values(val):
+    vals = val if isinstance(val, (list, tuple, set)) else [val]
+    return [norm_key(v) for v in vals]
+
+def _where_sql(sheet_name, filters):
+    clauses, params = [], []
+    for col, val in filters.items():
+        if col not in table_columns(sheet_name): raise ValueError(f"Unknown column {sheet_name}.{col}")
+        if isinstance(val, Between):
+            for bound, op in ((val.low, ">="), (val.high, "<=")):
+                if bound is not None: clauses.append(f'"{col}" {op} ?'); params.append(str(bound))
+            continue
+        vals = _filter_values(val)
+        if not vals: clauses.append("0"); continue
+        clauses.append(f'"{col}" = ?' if len(vals) == 1 else f'"{col}" IN (' + ", ".join("?" for _ in vals) + ")")
+        params.extend(vals)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+def fetch_records(sheet_name, **filters):
+    """Rows whose columns equal the given values; a list/tuple/set value matches any of its items,
+    a Between value a range. Local mode runs the filters as a parameterized WHERE clause over the indexed tables."""
+    return _cached_rows(sheet_name, _filter_key(filters), lambda: _load_records(sheet_name, filters))
+
+def _filter_key(filters):
+    def value_key(val):
+        if isinstance(val, Between): return ("between", str(val.low), str(val.high))
+        return tuple(sorted(_filter_values(val))) if isinstance(val, (list, tuple, set)) else norm_key(val)
+    return tuple(sorted((col, value_key(val)) for col, val in filters.items()))
+
+def _serve_local(sheet_name):
+    """True when the local table is the freshest copy: Local mode, no connection, or unpushed edits."""
+    return get_data_mode() == 'Local' or not get_cloud_connection() or has_pending_sync(sheet_name)
+
+def _load_records(sheet_name, filters):
+    if _serve_local(sheet_name):
+        try:
+            where, params = _where_sql(sheet_name, filters)
+            return _read_local(sheet_name, where, params)
+        except Exception as e:
+            print(f"Query Error ({sheet_name}): {e}")
+            return []
+    wanted = {col: val if isinstance(val, Between) else set(_filter_values(val)) for col, val in filters.items()}
+    # Every filter is answered from the one cached download of the sheet.
+    return [r for r in fetch_all_records(sheet_name)
+            if all(want.matches(r.get(col, "")) if isinstance(want, Between) else norm_key(r.get(col, "")) in want for col, want in wanted.items())]
+
 def fetch_all_records_local_fallback(sheet_name):
     try:
-        conn = sqlite3.connect(LOCAL_DB)
-        df = pd.read_sql(f"SELECT * FROM {sheet_name}", conn)
-        conn.close()
+        with get_db().connect() as conn:
+            df = pd.read_sql(f'SELECT * FROM "{sheet_name}"', conn)
         return df.fillna("").to_dict('records')
     except: return []
 
+SYNC_SHEETS = ["Users", "Credentials", "Subjects", "Students", "Grades", "Assessments", "TaskScores", "Config", "Attendance", "Blobs"]
+# Rows stamped shortly before the last watermark are re-read, to tolerate clock skew between servers.
+SYNC_OVERLAP_SECONDS = 120
+
+def _col_letter(n):
+    return gspread.utils.rowcol_to_a1(1, n).rstrip("0123456789")
+
+def _as_float(val):
+    try: return float(val)
+    except (TypeError, ValueError): return 0.0
+
+def _pending_sync_keys(conn, sheet_name):
+    return {r[0] for r in conn.execute("SELECT row_key FROM SyncOutbox WHERE sheet_name = ?", (sheet_name,))}
+
+def _full_pull_sheet(ws, sheet_name):
+    data, rekeyed = _rekey_duplicates(sheet_name, sheet_rows(sheet_name, ws.get_all_records()))
+    with get_db().transaction() as conn:
+        if _pending_sync_keys(conn, sheet_name): return False
+        if data: _local_replace(conn, sheet_name, data)
+        if rekeyed: enqueue_sync(conn, sheet_name, [None])
+        watermark = max([_as_float(r.get("updated_at")) for r in data] + [0.0])
+        conn.execute("INSERT OR REPLACE INTO SyncState VALUES (?, ?, ?)", (sheet_name, watermark, time.time()))
+    return bool(data)
+
+def delta_sync_sheet(sh, sheet_name):
+    """Merges rows changed in the sheet since the last watermark into SQLite; returns True if anything changed.
+    Only the key and updated_at columns are read in full; changed rows are fetched by range."""
+    ws = ensure_worksheet(sh, sheet_name)
+    headers = ws.row_values(1)
+    key = TABLE_KEYS[sheet_name]
+    with get_db().connect() as conn:
+        state = conn.execute("SELECT watermark FROM SyncState WHERE sheet_name = ?", (sheet_name,)).fetchone()
+        local_keys = {norm_key(r[0]) for r in conn.execute(f'SELECT "{key}" FROM "{sheet_name}"')} if state else set()
+    if state is None or key not in headers or "updated_at" not in headers:
+        return _full_pull_sheet(ws, sheet_name)
+
+    key_col = _col_letter(headers.index(key) + 1)
+    ts_col = _col_letter(headers.index("updated_at") + 1)
+    key_vals, ts_vals = ws.batch_get([f"{key_col}2:{key_col}", f"{ts_col}2:{ts_col}"], value_render_option="UNFORMATTED_VALUE")
+    since = state[0] - SYNC_OVERLAP_SECONDS
+    remote_keys, changed_rows, watermark = set(), [], state[0]
+    for i, kv in enumerate(key_vals):
+        if not kv or str(kv[0]) == "": continue
+        # A repeated key would merge two rows; the full pull re-keys them.
+        if norm_key(kv[0]) in remote_keys: return _full_pull_sheet(ws, sheet_name)
+        remote_keys.add(norm_key(kv[0]))
+        ts = _as_float(ts_vals[i][0]) if i < len(ts_vals) and ts_vals[i] else 0.0
+        # Rows never seen here are pulled whatever their stamp (typed into the sheet, or from an older app version)
+        if ts > since or norm_key(kv[0]) not in local_keys: changed_rows.append(i + 2)
+        watermark = max(watermark, ts)
+
+    # Contiguous runs of changed rows become one range each
+    ranges, last = [], _col_letter(len(headers))
+    for n in changed_rows:
+        if ranges and ranges[-1][1] == n - 1: ranges[-1][1] = n
+        else: ranges.append([n, n])
+    rows = []
+    if ranges:
+        for block in ws.batch_get([f"A{a}:{last}{b}" for a, b in ranges], value_render_option="UNFORMATTED_VALUE"):
+            for vals in block:
+                rows.append({h: (vals[j] if j < len(vals) else "") for j, h in enumerate(headers) if h})
+        rows = sheet_rows(sheet_name, rows)
+
+    with get_db().transaction() as conn:
+        pending = _pending_sync_keys(conn, sheet_name)
+        if None in pending: return False
+        rows = [r for r in rows if norm_key(r.get(key, "")) not in pending]
+        local_keys = {norm_key(r[0]) for r in conn.execute(f'SELECT "{key}" FROM "{sheet_name}"')}
+        gone = [k for k in local_keys - remote_keys if k not in pending]
+        if rows: _local_upsert(conn, sheet_name, rows)
+        if gone: _local_delete(conn, sheet_name, gone)
+        conn.execute("INSERT OR REPLACE INTO SyncState VALUES (?, ?, ?)", (sheet_name, watermark, time.time()))
+    return bool(rows or gone)
+
 def perform_login_sync():
     if is_online():
         try:
             sh = get_cloud_connection()
             if not sh: return False
-            conn = sqlite3.connect(LOCAL_DB)
-            sheets = ["Users", "Subjects", "Students", "Grades", "Tasks", "Config"]
-            for s in sheets:
+            # Push local edits first; rows that still have queued edits are not overwritten from the cloud.
+            get_sync_worker().flush()
+            for s in SYNC_SHEETS:
                 try:
-                    data = sh.worksheet(s).get_all_records()
-                    if data:
-                        df = pd.DataFrame(data)
-                        df.to_sql(s, conn, if_exists='replace', index=False)
-                except: pass
-            conn.close()
+                    if delta_sync_sheet(sh, s): invalidate_tables(s)
+                    cloud_call_succeeded()
+                except Exception as e:
+                    cloud_call_failed(e)
+                    print(f"Sync Error ({s}): {e}")
             return True
         except: return False
     return False
 
-def overwrite_sheet_data(sheet_name, data_list_of_dicts):
+def notify_local_save():
+    get_sync_worker().notify()
+    if get_data_mode() != 'Cloud':
+        st.toast("⚠️ Saved LOCALLY (Offline Mode). Changes will sync when back online.", icon="📂")
+
+# --- KEYED ROW WRITES ---
+# Writers send only the rows they changed, matched on TABLE_KEYS.
+_id_lock = threading.Lock()
+_last_row_id = [0]
+
+def new_row_id():
+    """Unique increasing integer id (microsecond clock) for Grades/Subjects rows."""
+    with _id_lock:
+        _last_row_id[0] = max(_last_row_id[0] + 1, time.time_ns() // 1000)
+        return _last_row_id[0]
+
+# Tables keyed by a generated id. Legacy ids were int(time.time()) + student id, which can collide.
+GENERATED_KEYS = {"Grades", "Subjects"}
+
+def _rekey_duplicates(sheet_name, rows):
+    """(rows, number re-keyed): every repeat of a generated key gets a fresh new_row_id() instead of overwriting."""
+    if sheet_name not in GENERATED_KEYS: return rows, 0
+    key, seen, out, n = TABLE_KEYS[sheet_name], set(), [], 0
+    for r in rows:
+        k = norm_key(r.get(key, ""))
+        if k and k in seen:
+            r, n = dict(r, **{key: new_row_id()}), n + 1
+            k = norm_key(r[key])
+        seen.add(k)
+        out.append(r)
+    return out, n
+
+def norm_key(val):
+    s = str(val).strip()
+    return s[:-2] if s.endswith('.0') else s
+
+def sql_value(val):
+    if val is None: return None
+    if hasattr(val, 'item'): val = val.item()
+    if isinstance(val, float) and val != val: return None
+    return val
+
+def cell_value(val):
+    val = sql_value(val)
+    return "" if val is None else val
+
+def _local_columns(conn, sheet_name):
+    return [r[1] for r in conn.execute(f'PRAGMA table_info("{sheet_name}")')]
+
+def _ensure_columns(conn, sheet_name, rows):
+    cols = _local_columns(conn, sheet_name)
+    for r in rows:
+        for c in r:
+            if c not in cols:
+                conn.execute(f'ALTER TABLE "{sheet_name}" ADD COLUMN "{c}"')
+                cols.append(c)
+
+def _row_params(sheet_name, row, names):
+    key = TABLE_KEYS[sheet_name]
+    return [norm_key(row[c]) if (c == key or c in ID_COLUMNS) and sql_value(row[c]) is not None else sql_value(row[c]) for c in names]
+
+def _insert_rows(conn, sheet_name, rows, conflict):
+    """Inserts rows grouped by column set; conflict is the clause used when the key exists."""
+    key = TABLE_KEYS[sheet_name]
+    groups = {}
+    for r in rows:
+        if sql_value(r.get(key)) is None or str(r.get(key)).strip() == "": continue
+        groups.setdefault(tuple(r.keys()), []).append(r)
+    for names, group in groups.items():
+        col_sql = ", ".join(f'"{c}"' for c in names)
+        sql = f'INSERT INTO "{sheet_name}" ({col_sql}) VALUES (' + ", ".join("?" for _ in names) + ")"
+        if conflict == "update":
+            updates = ", ".join(f'"{c}" = excluded."{c}"' for c in names if c != key)
+            sql += f' ON CONFLICT("{key}") DO ' + (f"UPDATE SET {updates}" if updates else "NOTHING")
+        else:
+            sql = sql.replace("INSERT INTO", "INSERT OR REPLACE INTO", 1)
+        conn.executemany(sql, [_row_params(sheet_name, r, names) for r in group])
+
+def _local_upsert(conn, sheet_name, rows):
+    with _derived_maintained(conn, sheet_name, [r.get(TABLE_KEYS[sheet_name]) for r in rows], rows):
+        _ensure_columns(conn, sheet_name, rows)
+        _insert_rows(conn, sheet_name, rows, "update")
+
+def _local_replace(conn, sheet_name, rows):
+    """Replaces the table contents in place, keeping its declared schema and indexes."""
+    with _derived_maintained(conn, sheet_name):
+        conn.execute(f'DELETE FROM "{sheet_name}"')
+        _ensure_columns(conn, sheet_name, rows)
+        _insert_rows(conn, sheet_name, rows, "replace")
+
+def _local_delete(conn, sheet_name, keys):
+    key = TABLE_KEYS[sheet_name]
+    with _derived_maintained(conn, sheet_name, keys):
+        conn.executemany(f'DELETE FROM "{sheet_name}" WHERE "{key}" = ?', [(norm_key(k),) for k in keys])
+
+@contextlib.contextmanager
+def _derived_maintained(conn, sheet_name, keys=None, rows=()):
+    """Wraps a local write to sheet_name (keys None: a full replace) so the derived tables follow it."""
+    with _summary_maintained(conn, sheet_name, keys, rows), _counters_maintained(conn, sheet_name, keys), \
+         _attendance_totals_maintained(conn, sheet_name, keys):
+        yield
+
+# --- GRADE SUMMARY ---
+def _in_chunks(conn, sql, values, size=500):
+    """Runs sql once per chunk of values, its {marks} filled with that many placeholders; yields the cursors."""
+    values = list(values)
+    for i in range(0, len(values), size):
+        chunk = values[i:i + size]
+        yield conn.execute(sql.format(marks=", ".join("?" for _ in chunk)), chunk)
+
+@contextlib.contextmanager
+def _summary_maintained(conn, sheet_name, keys=None, rows=()):
+    """Wraps a local write so GradeSummary follows it: a Grades write rebuilds the rows of the students it
+    touched (all of them after a full replace); a grading scale change in Config re-grades the GPAs."""
+    if sheet_name not in ("Grades", "Config") or not _table_exists(conn, "GradeSummary"):
+        yield
+        return
+    if sheet_name == "Grades":
+        students = None
+        if keys is not None:
+            students = {norm_key(r.get("student_id")) for r in rows}
+            for cur in _in_chunks(conn, "SELECT DISTINCT student_id FROM Grades WHERE id IN ({marks})", [norm_key(k) for k in keys]):
+                students.update(sid for (sid,) in cur)
+        yield
+        refresh_grade_summary(conn, students)
+    else:
+        rescaled = keys is None or any(str(k).startswith(grading_scale_key("")) for k in keys)
+        yield
+        if rescaled: regrade_summary(conn)
+
+def _local_scales(conn):
+    rows = pd.read_sql("SELECT year, task_name, max_score FROM Config WHERE test_name = ?", conn, params=[GRADING_SCALE_TEST]).to_dict('records')
+    return lambda year: _scale_in_force(rows, year)
+
+def refresh_grade_summary(conn, students=None):
+    """Rebuilds the GradeSummary rows of the given student ids, or the whole table when None."""
+    if students is None:
+        conn.execute("DELETE FROM GradeSummary")
+        grades = pd.read_sql("SELECT * FROM Grades", conn)
+    else:
+        students = sorted(s for s in students if s)
+        if not students: return
+        for _ in _in_chunks(conn, "DELETE FROM GradeSummary WHERE student_id IN ({marks})", students): pass
+        grades = pd.concat([pd.DataFrame(cur.fetchall(), columns=[d[0] for d in cur.description])
+                            for cur in _in_chunks(conn, "SELECT * FROM Grades WHERE student_id IN ({marks})", students)])
+    cols = table_columns("GradeSummary")
+    summary = summarize_grades(grades, _local_scales(conn))
+    conn.executemany(f"INSERT INTO GradeSummary ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)})",
+                     [[sql_value(v) for v in r] for r in summary[cols].itertuples(index=False)])
+
+def regrade_summary(conn):
+    """Re-applies the grading scales to every summary row's semester totals."""
+    df = pd.read_sql("SELECT rowid, school_year, sem1_total, sem2_total FROM GradeSummary", conn)
+    scale_for = _local_scales(conn)
+    for yr, g in df.groupby('school_year'):
+        scale = scale_for(yr)
+        conn.executemany("UPDATE GradeSummary SET sem1_gpa = ?, sem2_gpa = ? WHERE rowid = ?",
+                         zip(scale.apply(g['sem1_total']).tolist(), scale.apply(g['sem2_total']).tolist(), g['rowid'].tolist()))
+
+# --- DASHBOARD COUNTERS ---
+# Source table -> (the counters it feeds, the (counter, bucket) pairs one of its rows adds 1 to).
+# Grades rows feed SubjectStudents through the "subject_rows" pairs instead of a counter of their own.
+COUNTED_TABLES = {
+    "Users": (["users"], lambda r: [("users", "")]),
+    "Subjects": (["subjects"], lambda r: [("subjects", "")]),
+    "Students": (["students_status", "active_level"], lambda r: [("students_status", cell_value(r.get("status")))] +
+                 ([("active_level", cell_value(r.get("grade_level")))] if r.get("status") == "Active" else [])),
+    "Grades": (["subject_students"], lambda r: [("subject_rows", (cell_value(r.get("subject")), cell_value(r.get("student_id"))))]),
+}
+
+def _count_rows(sheet_name, rows):
+    counts = collections.Counter()
+    for r in rows: counts.update(COUNTED_TABLES[sheet_name][1](r))
+    return counts
+
+def _select_keyed(conn, sheet_name, keys):
+    cur_rows = []
+    for cur in _in_chunks(conn, f'SELECT * FROM "{sheet_name}" WHERE "{TABLE_KEYS[sheet_name]}" IN ({{marks}})', keys):
+        cols = [d[0] for d in cur.description]
+        cur_rows.extend(dict(zip(cols, r)) for r in cur)
+    return cur_rows
+
+def _bump(conn, counter, bucket, delta):
+    conn.execute("INSERT INTO DashboardCounters (counter, bucket, value) VALUES (?, ?, ?) ON CONFLICT(counter, bucket) DO UPDATE SET value = value + excluded.value", (counter, bucket, delta))
+    conn.execute("DELETE FROM DashboardCounters WHERE counter = ? AND bucket = ? AND value = 0", (counter, bucket))
+
+@contextlib.contextmanager
+def _counters_maintained(conn, sheet_name, keys=None):
+    """Applies a local write's effect to the counters: the counted keys are read before and after it and
+    only the difference is added, so the cost follows the size of the write, not of the table."""
+    if sheet_name not in COUNTED_TABLES or not _table_exists(conn, "DashboardCounters"):
+        yield
+        return
+    if keys is None:
+        yield
+        recount_dashboard(conn, sheet_name)
+        return
+    keys = [norm_key(k) for k in keys]
+    before = _count_rows(sheet_name, _select_keyed(conn, sheet_name, keys))
+    yield
+    deltas = _count_rows(sheet_name, _select_keyed(conn, sheet_name, keys))
+    deltas.subtract(before)
+    for (counter, bucket), d in deltas.items():
+        if not d: continue
+        if counter != "subject_rows":
+            _bump(conn, counter, bucket, d)
+            continue
+        row = conn.execute("SELECT grade_rows FROM SubjectStudents WHERE subject = ? AND student_id = ?", bucket).fetchone()
+        old = row[0] if row else 0
+        if old + d > 0: conn.execute("INSERT OR REPLACE INTO SubjectStudents (subject, student_id, grade_rows) VALUES (?, ?, ?)", (*bucket, old + d))
+        else: conn.execute("DELETE FROM SubjectStudents WHERE subject = ? AND student_id = ?", bucket)
+        if (old > 0) != (old + d > 0): _bump(conn, "subject_students", bucket[0], 1 if old + d > 0 else -1)
+
+def recount_dashboard(conn, sheet_name):
+    """Recomputes the counters fed by sheet_name from a full read of it."""
+    conn.executemany("DELETE FROM DashboardCounters WHERE counter = ?", [(c,) for c in COUNTED_TABLES[sheet_name][0]])
+    if sheet_name == "Grades":
+        conn.execute("DELETE FROM SubjectStudents")
+        conn.execute("INSERT INTO SubjectStudents SELECT COALESCE(subject, ''), COALESCE(student_id, ''), COUNT(*) FROM Grades GROUP BY 1, 2")
+        conn.execute("INSERT INTO DashboardCounters SELECT 'subject_students', subject, COUNT(*) FROM SubjectStudents GROUP BY subject")
+        return
+    cur = conn.execute(f'SELECT * FROM "{sheet_name}"')
+    cols = [d[0] for d in cur.description]
+    counts = _count_rows(sheet_name, (dict(zip(cols, r)) for r in cur))
+    conn.executemany("INSERT INTO DashboardCounters (counter, bucket, value) VALUES (?, ?, ?)", [(c, b, n) for (c, b), n in counts.items() if n])
+
+
+# --- ATTENDANCE TOTALS ---
+# Prefix sums: the counts of a date window are the totals at its last date minus those before its first.
+def _attendance_day_counts(rows):
+    """{(student_id, subject, date): Counter(status)} over the rows with one of ATTENDANCE_STATUSES."""
+    days = collections.defaultdict(collections.Counter)
+    for r in rows:
+        if r.get("status") in ATTENDANCE_STATUSES: days[(cell_value(r.get("student_id")), cell_value(r.get("subject")), cell_value(r.get("date")))][r["status"]] += 1
+    return days
+
+def _shift_attendance_totals(conn, day, delta):
+    """Adds delta ({status: n}) to the totals of day's student and subject from day's date on."""
+    sid, subject, date = day
+    if not conn.execute("SELECT 1 FROM AttendanceTotals WHERE student_id = ? AND subject = ? AND date = ?", day).fetchone():
+        prev = conn.execute("SELECT Present, Late, Absent, Excused FROM AttendanceTotals WHERE student_id = ? AND subject = ? AND date < ? ORDER BY date DESC LIMIT 1", day).fetchone()
+        conn.execute("INSERT INTO AttendanceTotals VALUES (?, ?, ?, ?, ?, ?, ?)", (*day, *(prev or (0, 0, 0, 0))))
+    conn.execute("UPDATE AttendanceTotals SET " + ", ".join(f"{c} = {c} + ?" for c in ATTENDANCE_STATUSES) + " WHERE student_id = ? AND subject = ? AND date >= ?",
+                 [delta.get(c, 0) for c in ATTENDANCE_STATUSES] + [sid, subject, date])
+
+@contextlib.contextmanager
+def _attendance_totals_maintained(conn, sheet_name, keys=None):
+    """Applies an Attendance write to the running totals: only the days it changed are shifted."""
+    if sheet_name != "Attendance" or not _table_exists(conn, "AttendanceTotals"):
+        yield
+        return
+    if keys is None:
+        yield
+        rebuild_attendance_totals(conn)
+        return
+    keys = [norm_key(k) for k in keys]
+    before = _attendance_day_counts(_select_keyed(conn, sheet_name, keys))
+    yield
+    after = _attendance_day_counts(_select_keyed(conn, sheet_name, keys))
+    for day in set(before) | set(after):
+        delta = after.get(day, collections.Counter())
+        delta.subtract(before.get(day, collections.Counter()))
+        if any(delta.values()): _shift_attendance_totals(conn, day, delta)
+
+def rebuild_attendance_totals(conn):
+    conn.execute("DELETE FROM AttendanceTotals")
+    sums = ", ".join(f"SUM(SUM(status = '{c}')) OVER w" for c in ATTENDANCE_STATUSES)
+    conn.execute(f"""INSERT INTO AttendanceTotals SELECT COALESCE(student_id, ''), COALESCE(subject, ''), COALESCE(date, ''), {sums}
+                     FROM Attendance WHERE status IN ({", ".join(f"'{c}'" for c in ATTENDANCE_STATUSES)})
+                     GROUP BY 1, 2, 3 WINDOW w AS (PARTITION BY COALESCE(student_id, ''), COALESCE(subject, '') ORDER BY COALESCE(date, ''))""")
+
+def _sheet_key_rows(ws, headers, key):
+    """Maps normalized key -> 1-based sheet row number, reading only the key column."""
+    col = ws.col_values(headers.index(key) + 1)
+    return {norm_key(v): i + 1 for i, v in enumerate(col) if i > 0 and str(v) != ""}
+
+def _cloud_upsert(ws, sheet_name, rows):
+    key = TABLE_KEYS[sheet_name]
+    headers = ws.row_values(1)
+    # A sheet keeps its own headers: a column it heads by an alias is written under that alias.
+    names = canonical_headers(sheet_name, tuple(headers))
+    new_cols = []
+    for r in rows:
+        for c in r:
+            if c not in names and c not in new_cols: new_cols.append(c)
+    if new_cols:
+        headers, names = headers + new_cols, names + tuple(new_cols)
+        if ws.col_count < len(headers): ws.add_cols(len(headers) - ws.col_count)
+        ws.update(range_name="A1", values=[headers])
+    row_of = _sheet_key_rows(ws, list(names), key)
+    last_col = gspread.utils.rowcol_to_a1(1, len(headers)).rstrip("0123456789")
+    updates, appends = [], []
+    for r in rows:
+        values = [cell_value(r.get(h, "")) for h in names]
+        n = row_of.get(norm_key(r[key]))
+        if n: updates.append({"range": f"A{n}:{last_col}{n}", "values": [values]})
+        else: appends.append(values)
+    if updates: ws.batch_update(updates)
+    if appends: ws.append_rows(appends)
+
+def _cloud_delete(sh, ws, sheet_name, keys):
+    headers = list(canonical_headers(sheet_name, tuple(ws.row_values(1))))
+    if TABLE_KEYS[sheet_name] not in headers: return
+    row_of = _sheet_key_rows(ws, headers, TABLE_KEYS[sheet_name])
+    targets = sorted({row_of[norm_key(k)] for k in keys if norm_key(k) in row_of}, reverse=True)
+    if not targets: return
+    requests = [{"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": n - 1, "endIndex": n}}} for n in targets]
+    sh.batch_update({"requests": requests})
+
+def upsert_records(sheet_name, rows):
+    """Inserts or updates only the given rows, matched on the table's key column."""
+    now = round(time.time(), 3)
+    rows = [dict(r, updated_at=now) for r in rows]
+    if not rows: return
+    # The local write is the only way to the cloud: a failure propagates rather than being reported as saved.
+    with get_db().transaction() as conn:
+        _local_upsert(conn, sheet_name, rows)
+        enqueue_sync(conn, sheet_name, [r[TABLE_KEYS[sheet_name]] for r in rows])
+    invalidate_tables(sheet_name)
+    notify_local_save()
+
+def delete_records(sheet_name, keys):
+    """Deletes only the rows whose key column matches one of keys."""
+    keys = list(keys)
+    if not keys: return
+    with get_db().transaction() as conn:
+        _local_delete(conn, sheet_name, keys)
+        enqueue_sync(conn, sheet_name, keys)
+    invalidate_tables(sheet_name)
+    notify_local_save()
+
+# --- CLOUD SYNC QUEUE ---
+def enqueue_sync(conn, sheet_name, keys):
+    """Queues keys (None = whole table) for the cloud, inside the caller's local write transaction."""
+    now = time.time()
+    conn.executemany("INSERT INTO SyncOutbox (sheet_name, row_key, queued_at, next_attempt_at) VALUES (?, ?, ?, 0)",
+                     [(sheet_name, None if k is None else norm_key(k), now) for k in keys])
+
+def has_pending_sync(sheet_name):
     try:
-        conn = sqlite3.connect(LOCAL_DB)
-        df = pd.DataFrame(data_list_of_dicts)
-        df.to_sql(sheet_name, conn, if_exists='replace', index=False)
-        conn.close()
-    except Exception as e:
-        print(f"Local Save Error: {e}")
-
-    if get_data_mode() == 'Cloud':
-        try:
+        with get_db().connect() as conn:
+            return conn.execute("SELECT 1 FROM SyncOutbox WHERE sheet_name = ? LIMIT 1", (sheet_name,)).fetchone() is not None
+    except sqlite3.Error: return False
+
+def get_sync_status():
+    """(queued changes, seconds since the oldest was queued, last push error)."""
+    with get_db().connect() as conn:
+        depth, oldest = conn.execute("SELECT COUNT(*), MIN(queued_at) FROM SyncOutbox").fetchone()
+    return depth, (time.time() - oldest) if oldest else 0.0, get_sync_worker().last_error
+
+CREDENTIAL_DEPENDENT = ("Users", "Students")
+
+class CloudSyncWorker:
+    """Background thread draining SyncOutbox into Google Sheets.
+    Pending keys are coalesced per worksheet and the current local rows are sent in one batched push;
+    failures are retried with exponential backoff."""
+    IDLE_SECONDS = 5
+    BASE_BACKOFF = 2
+    MAX_BACKOFF = 300
+    CHUNK = 500
+
+    def __init__(self, db):
+        self.db = db
+        self.last_error = None
+        self.last_push = None
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        threading.Thread(target=self._run, name="sgs-cloud-sync", daemon=True).start()
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.IDLE_SECONDS)
+            self._wake.clear()
+            try: self.flush()
+            except Exception as e: print(f"Sync Worker Error: {e}")
+
+    def flush(self):
+        with self._flush_lock:
+            if get_data_mode() != 'Cloud': return
             sh = get_cloud_connection()
-            if sh:
-                ws = sh.worksheet(sheet_name)
-                if len(data_list_of_dicts) > 0:
-                    headers = list(data_list_of_dicts[0].keys())
-                    rows = [headers] + [list(d.values()) for d in data_list_of_dicts]
-                    ws.clear()
-                    ws.append_rows(rows)
-                else: ws.clear()
-        except:
-            st.toast("⚠️ Saved LOCALLY. Cloud update failed (Connection unstable).", icon="📂")
-    else:
-        st.toast("⚠️ Saved LOCALLY only (Offline Mode).", icon="📂")
+            if not sh: return
+            with self.db.connect() as conn:
+                pending = conn.execute("SELECT id, sheet_name, row_key, attempts FROM SyncOutbox WHERE next_attempt_at <= ? ORDER BY id", (time.time(),)).fetchall()
+            by_sheet = {}
+            for oid, sheet_name, row_key, attempts in pending:
+                by_sheet.setdefault(sheet_name, []).append((oid, row_key, attempts))
+            for sheet_name, items in sorted(by_sheet.items(), key=lambda kv: kv[0] != "Credentials"):
+                # Users/Students rows may blank a plaintext password: they wait until the hashes are on the sheet.
+                if sheet_name in CREDENTIAL_DEPENDENT and self._credentials_queued(): continue
+                ids = [i[0] for i in items]
+                try:
+                    self._push_sheet(sh, sheet_name, {i[1] for i in items})
+                    with self.db.transaction() as conn:
+                        for n in range(0, len(ids), self.CHUNK):
+                            chunk = ids[n:n + self.CHUNK]
+                            conn.execute("DELETE FROM SyncOutbox WHERE id IN (" + ", ".join("?" for _ in chunk) + ")", chunk)
+                    self.last_push = time.time()
+                    self.last_error = None
+                    cloud_call_succeeded()
+                except Exception as e:
+                    self.last_error = f"{sheet_name}: {e}"
+                    cloud_call_failed(e)
+                    delay = min(self.MAX_BACKOFF, self.BASE_BACKOFF * 2 ** max(i[2] for i in items))
+                    with self.db.transaction() as conn:
+                        conn.executemany("UPDATE SyncOutbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                                         [(time.time() + delay, str(e), i) for i in ids])
+
+    def _credentials_queued(self):
+        with self.db.connect() as conn:
+            return conn.execute("SELECT 1 FROM SyncOutbox WHERE sheet_name = 'Credentials' LIMIT 1").fetchone() is not None
+
+    def _push_sheet(self, sh, sheet_name, keys):
+        ws = ensure_worksheet(sh, sheet_name)
+        if None in keys:
+            # A whole-table replace supersedes any row-level changes queued with it.
+            rows = _read_local(sheet_name)
+            ws.clear()
+            if rows: ws.append_rows([list(rows[0].keys())] + [[cell_value(v) for v in r.values()] for r in rows])
+            return
+        key = TABLE_KEYS[sheet_name]
+        keys = sorted(keys)
+        rows = []
+        for n in range(0, len(keys), self.CHUNK):
+            where, params = _where_sql(sheet_name, {key: keys[n:n + self.CHUNK]})
+            rows += _read_local(sheet_name, where, params)
+        present = {norm_key(r[key]) for r in rows}
+        if rows: _cloud_upsert(ws, sheet_name, rows)
+        gone = [k for k in keys if k not in present]
+        if gone: _cloud_delete(sh, ws, sheet_name, gone)
 
-def clear_cache():
-    st.cache_data.clear()
+@st.cache_resource
+def get_sync_worker():
+    return CloudSyncWorker(get_db())
 
 # --- HELPER FUNCTIONS ---
 def get_school_years():
@@ -305,31 +1382,6 @@ def fmt_score(val):
     if val % 1 == 0: return f"{int(val)}"
     return f"{val:.1f}"
 
-def get_sem_gpa(score):
-    """
-    Custom Grading Scale:
-    80-100 = 4.0 | 75-79 = 3.5 | 70-74 = 3.0 | 65-69 = 2.5
-    60-64  = 2.0 | 55-59 = 1.5 | 50-54 = 1.0 | 0-49  = 0.0
-    """
-    if score >= 80: return 4.0
-    elif score >= 75: return 3.5
-    elif score >= 70: return 3.0
-    elif score >= 65: return 2.5
-    elif score >= 60: return 2.0
-    elif score >= 55: return 1.5
-    elif score >= 50: return 1.0
-    else: return 0.0
-
-def get_grade_point(score):
-    if score >= 80: return 4.0
-    elif score >= 75: return 3.5
-    elif score >= 70: return 3.0
-    elif score >= 65: return 2.5
-    elif score >= 60: return 2.0
-    elif score >= 55: return 1.5
-    elif score >= 50: return 1.0
-    else: return 0.0
-
 def image_to_base64(img_bytes):
     if not img_bytes: return ""
     try:
@@ -349,278 +1401,431 @@ def base64_to_image(b64_str):
 def clean_id(val):
     return str(val).strip().replace('.0', '')
 
+# --- BLOB STORE ---
+# Photos are stored once in Blobs, keyed by the SHA-256 of their JPEG bytes, and only fetched
+# where a photo is shown. Thumbnails are rendered once per (hash, size) as WebP and JPEG into the
+# static folder, which Streamlit serves at app/static/ (server.enableStaticServing).
+BLOB_PREFIX = "sha256:"
+THUMB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "thumbs")
+THUMB_URL = "app/static/thumbs"
+THUMB_SIZES = {"sm": 64, "md": 200, "lg": 360}
+THUMB_FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+THUMB_WORKERS = 4
+
+def get_blobs(hashes):
+    """{blob_hash: base64 data}. Blobs are content-addressed and never change, so the synced local table answers
+    first; in Cloud mode only the hashes missing locally are read from the sheet (just their rows) and kept."""
+    hashes = {str(h) for h in hashes if h}
+    found = {}
+    if not hashes: return found
+    with get_db().connect() as conn:
+        for cur in _in_chunks(conn, "SELECT blob_hash, data FROM Blobs WHERE blob_hash IN ({marks})", sorted(hashes)): found.update(cur.fetchall())
+    missing = hashes - set(found)
+    sh = get_cloud_connection() if missing and get_data_mode() == 'Cloud' else None
+    if not sh: return found
+    try:
+        ws = sh.worksheet("Blobs")
+        headers = ws.row_values(1)
+        row_of = _sheet_key_rows(ws, headers, "blob_hash")
+        wanted = sorted(row_of[h] for h in missing if h in row_of)
+        if wanted:
+            last = _col_letter(len(headers))
+            rows = [dict(zip(headers, block[0])) for block in ws.batch_get([f"A{n}:{last}{n}" for n in wanted]) if block]
+            with get_db().transaction() as conn: _local_upsert(conn, "Blobs", rows)
+            found.update({r['blob_hash']: r['data'] for r in rows})
+        cloud_call_succeeded()
+    except Exception as e:
+        cloud_call_failed(e)
+        print(f"Blob Fetch Error: {e}")
+    return found
+
+def store_photo(img_bytes):
+    """Saves an uploaded image and returns the reference to keep in a photo column ("" if unreadable)."""
+    b64 = image_to_base64(img_bytes)
+    if not b64: return ""
+    blob_hash = hashlib.sha256(base64.b64decode(b64)).hexdigest()
+    if not get_blobs([blob_hash]):
+        upsert_records("Blobs", [{"blob_hash": blob_hash, "mime": "image/jpeg", "data": b64}])
+    return BLOB_PREFIX + blob_hash
+
+def _photo_key(ref):
+    return ref[len(BLOB_PREFIX):] if ref.startswith(BLOB_PREFIX) else hashlib.sha256(ref.encode()).hexdigest()
+
+def _thumb_path(key, size, ext):
+    return os.path.join(THUMB_DIR, f"{key}_{size}.{ext}")
+
+def _render_thumbnails(key, data, size):
+    """Writes every format variant of one thumbnail size; runs in worker threads."""
+    img = Image.open(io.BytesIO(data))
+    img.thumbnail((size, size))
+    if img.mode in ("RGBA", "P"): img = img.convert("RGB")
+    os.makedirs(THUMB_DIR, exist_ok=True)
+    for ext, fmt in THUMB_FORMATS.items():
+        path = _thumb_path(key, size, ext)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        img.save(tmp, format=fmt, quality=82)
+        os.replace(tmp, path)
+
+def prepare_thumbnails(refs, size):
+    """Renders the missing thumbnails for many photos at once, e.g. a whole class roster:
+    one Blobs lookup for the images, then decoding/encoding spread over a thread pool."""
+    refs = {str(r) for r in refs if r and str(r) != "nan"}
+    missing = {_photo_key(r): r for r in refs if not all(os.path.exists(_thumb_path(_photo_key(r), size, ext)) for ext in THUMB_FORMATS)}
+    if not missing: return
+    hashes = [k for k, r in missing.items() if r.startswith(BLOB_PREFIX)]
+    blobs = get_blobs(hashes)
+    jobs = [(k, base64_to_image(blobs.get(k) if r.startswith(BLOB_PREFIX) else r)) for k, r in missing.items()]
+    with ThreadPoolExecutor(max_workers=THUMB_WORKERS) as pool:
+        futures = [pool.submit(_render_thumbnails, k, data, size) for k, data in jobs if data]
+        for f in futures:
+            try: f.result()
+            except Exception as e: print(f"Thumbnail Error: {e}")
+
+def photo_thumbnail(ref, size, ext="jpg"):
+    """Path of a thumbnail (longest side = size) for a photo column value, or None."""
+    ref = str(ref or "")
+    if not ref: return None
+    prepare_thumbnails([ref], size)
+    path = _thumb_path(_photo_key(ref), size, ext)
+    return path if os.path.exists(path) else None
+
+def photo_url(ref, size, ext="webp"):
+    """Static URL of a thumbnail. The file name carries the content hash, so a URL never changes
+    content and browsers can keep it cached."""
+    path = photo_thumbnail(ref, size, ext)
+    return f"{THUMB_URL}/{os.path.basename(path)}" if path else None
+
+# --- EXCEL EXPORT ---
+# Workbooks are written straight to disk in xlsxwriter constant_memory mode, one row at a time from
+# generators, and kept under a key made of the data versions they were built from.
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "export_cache")
+EXPORT_MAX_AGE = 6 * 3600
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def frame_sheet(name, df):
+    """(sheet name, header, row generator) for a DataFrame, without copying it."""
+    return name, [str(c) for c in df.columns], df.itertuples(index=False, name=None)
+
+def write_workbook(path, sheets):
+    """sheets: iterable of (name, header, rows); may be a generator, so each sheet's rows are only
+    produced while it is written."""
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True, "tmpdir": EXPORT_DIR, "nan_inf_to_errors": True})
+    try:
+        used = set()
+        for name, header, rows in sheets:
+            # Excel sheet names: max 31 chars, no []:*?/\, unique
+            title = "".join("_" if ch in "[]:*?/\\" else ch for ch in str(name))[:31] or "Sheet"
+            while title.lower() in used: title = f"{title[:28]}_{len(used)}"
+            used.add(title.lower())
+            ws = wb.add_worksheet(title)
+            ws.write_row(0, 0, header)
+            for n, row in enumerate(rows, start=1): ws.write_row(n, 0, [sql_value(v) for v in row])
+    finally:
+        wb.close()
+
+def _prune_exports():
+    cutoff = time.time() - EXPORT_MAX_AGE
+    for f in os.listdir(EXPORT_DIR):
+        try:
+            if os.path.getmtime(os.path.join(EXPORT_DIR, f)) < cutoff: os.remove(os.path.join(EXPORT_DIR, f))
+        except OSError: pass
+
+def export_workbook(key, tables, build):
+    """Path of an .xlsx built by build() -> sheets (see write_workbook).
+    The file is reused until one of the tables it was derived from is written (in Cloud mode, also
+    until the read-cache TTL rolls over), so repeated downloads don't rebuild it."""
+    cache = get_table_cache()
+    versions = [(t, cache.versions[t]) for t in sorted(tables)]
+    window = None if get_data_mode() == 'Local' else int(time.time() // TableCache.TTL)
+    digest = hashlib.sha256(repr((cache.epoch, key, versions, window)).encode()).hexdigest()[:24]
+    path = os.path.join(EXPORT_DIR, f"{digest}.xlsx")
+    if not os.path.exists(path):
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        _prune_exports()
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        write_workbook(tmp, build())
+        os.replace(tmp, path)
+    return path
+
+def download_workbook(label, path, file_name, key=None):
+    """path may also be a callable returning one (e.g. an export_workbook call): the workbook is then only
+    built or fetched from the export cache when the button is clicked."""
+    if callable(path):
+        def data(make=path):
+            with open(make(), "rb") as f: return f.read()
+        st.download_button(label=label, data=data, file_name=file_name, mime=XLSX_MIME, key=key)
+        return
+    with open(path, "rb") as f:
+        st.download_button(label=label, data=f, file_name=file_name, mime=XLSX_MIME, key=key)
+
 # --- CONFIG & TASKS ---
+# Grades column each test's weighted score is written to.
+TEST_COLUMNS = {"Test 1": "test1", "Test 2": "test2", "Test 3": "test3", "Final Exam": "final_score"}
+
+def grade_total(g):
+    """total_score of a Grades row: the sum of its test columns."""
+    return sum(float(g.get(c) or 0) for c in TEST_COLUMNS.values())
+
+def assessment_key(subject, quarter, year, test_name):
+    return f"{subject}_{quarter}_{year}_{test_name}"
+
+def task_score_key(student_id, assessment_id, task_no):
+    return f"{student_id}_{assessment_id}_{task_no}"
+
+def task_no_of(task_name):
+    name = str(task_name)
+    return int(name[5:]) if name.startswith("Task ") and name[5:].strip().isdigit() else None
+
+def _ensure_assessment(subject, quarter, year, test_name):
+    aid = assessment_key(subject, quarter, year, test_name)
+    if not fetch_records("Assessments", assessment_id=aid):
+        upsert_records("Assessments", [{"assessment_id": aid, "subject": subject, "quarter": quarter, "school_year": year, "test_name": test_name}])
+    return aid
+
+def get_task_max_scores(subject, quarter, year, test_name):
+    """Series of max score per task number for one test."""
+    configs = pd.DataFrame(fetch_records("Config", assessment_id=assessment_key(subject, quarter, year, test_name)))
+    if configs.empty: return pd.Series(dtype=float)
+    task_no = pd.to_numeric(configs['task_no'], errors='coerce')
+    configs = configs[task_no.notna()]
+    return pd.to_numeric(configs['max_score'], errors='coerce').fillna(0).groupby(task_no.dropna().astype(int)).sum()
+
 def get_task_max_score(subject, quarter, year, test_name, task_name):
-    configs = fetch_all_records("Config")
-    uid = f"{subject}_{quarter}_{year}_{test_name}_{task_name}"
-    for c in configs:
-        if c.get('uid') == uid: return float(c.get('max_score', 0))
-    return 0.0
+    return float(get_task_max_scores(subject, quarter, year, test_name).get(task_no_of(task_name), 0.0))
 
 def save_task_max_score(subject, quarter, year, test_name, task_name, max_val):
-    configs = fetch_all_records("Config")
-    uid = f"{subject}_{quarter}_{year}_{test_name}_{task_name}"
-    configs = [c for c in configs if c.get('uid') != uid]
-    configs.append({"uid": uid, "subject": subject, "quarter": quarter, "year": year, "test_name": test_name, "task_name": task_name, "max_score": float(max_val)})
-    overwrite_sheet_data("Config", configs)
-    clear_cache()
+    aid = _ensure_assessment(subject, quarter, year, test_name)
+    upsert_records("Config", [{"uid": f"{aid}_{task_name}", "subject": subject, "quarter": quarter, "year": year, "test_name": test_name, "task_name": task_name, "max_score": float(max_val), "assessment_id": aid, "task_no": task_no_of(task_name)}])
 
 def get_total_max_score_for_test(subject, quarter, year, test_name):
-    configs = fetch_all_records("Config")
-    total = 0.0
-    for c in configs:
-        if c['subject'] == subject and c['quarter'] == quarter and c['year'] == year and c['test_name'] == test_name:
-            total += float(c.get('max_score', 0))
-    return total
+    return float(get_task_max_scores(subject, quarter, year, test_name).sum())
 
 def get_enabled_tasks_count(subject, quarter, year, test_name):
-    configs = fetch_all_records("Config")
-    count = 0
-    for i in range(1, 11):
-        t_name = f"Task {i}"
-        uid = f"{subject}_{quarter}_{year}_{test_name}_{t_name}"
-        for c in configs:
-            if c.get('uid') == uid: 
-                count = i
-                break
-    return max(1, count) 
+    maxes = get_task_max_scores(subject, quarter, year, test_name)
+    return max(1, int(maxes.index.max())) if not maxes.empty else 1
+
+def get_task_score_matrix(subject, quarter, year, test_name):
+    """Task scores of one test: one row per student id, one column per task number."""
+    df = pd.DataFrame(fetch_records("TaskScores", assessment_id=assessment_key(subject, quarter, year, test_name)))
+    if df.empty: return pd.DataFrame(dtype=float)
+    df['task_no'] = pd.to_numeric(df['task_no'], errors='coerce')
+    df['score'] = pd.to_numeric(df['score'], errors='coerce').fillna(0)
+    df = df.dropna(subset=['task_no']).astype({'task_no': int})
+    return df.pivot_table(index='student_id', columns='task_no', values='score', aggfunc='sum')
+
+def _apply_test_scores(subject, quarter, year, test_name, weighted, teacher):
+    """Writes {student_id: weighted score} into the test's Grades column and recomputes total_score."""
+    col = next((c for t, c in TEST_COLUMNS.items() if test_name.startswith(t)), None)
+    existing = {clean_id(g['student_id']): g for g in fetch_records("Grades", subject=subject, quarter=quarter, school_year=year)}
+    now = str(datetime.datetime.now())
+    changed_grades = []
+    for sid, score in weighted.items():
+        g = existing.get(sid) or {"id": new_row_id(), "student_id": sid, "subject": subject, "quarter": quarter, "school_year": year, "test1": 0, "test2": 0, "test3": 0, "final_score": 0}
+        if col: g[col] = score
+        g['total_score'] = grade_total(g)
+        g['recorded_by'] = teacher
+        g['timestamp'] = now
+        changed_grades.append(g)
+    upsert_records("Grades", changed_grades)
+
+def save_task_scores(subject, quarter, year, test_name, scores, max_score, weight, teacher):
+    """scores: DataFrame indexed by student id with one column per task number.
+    Upserts only the task scores that changed, then re-weights the students' test totals into Grades."""
+    aid = _ensure_assessment(subject, quarter, year, test_name)
+    scores = scores.apply(pd.to_numeric, errors='coerce').fillna(0)
+    current = get_task_score_matrix(subject, quarter, year, test_name)
+    old = current.reindex(index=scores.index, columns=scores.columns)
+    # Blank tasks stay absent rather than being stored as zeros
+    changed = (scores.ne(old) & ~(old.isna() & scores.eq(0))).stack()
+    upsert_records("TaskScores", [{"uid": task_score_key(sid, aid, n), "student_id": sid, "assessment_id": aid, "task_no": int(n), "score": float(scores.at[sid, n])} for sid, n in changed[changed].index])
+
+    raw = scores.combine_first(current).reindex(scores.index).fillna(0).sum(axis=1)
+    weighted = (raw / max_score * weight).clip(upper=weight) if max_score > 0 else raw * 0.0
+    _apply_test_scores(subject, quarter, year, test_name, weighted.to_dict(), teacher)
+
+def _scores_frame(df, task_cols):
+    frame = df[list(task_cols.values())].copy()
+    frame.columns = list(task_cols.keys())
+    frame.index = df['ID'].map(clean_id)
+    return frame[~frame.index.duplicated(keep='last')]
 
 def update_specific_task_column(subject, quarter, year, test_name, task_col, df_input, teacher, total_max_score, weight):
-    all_tasks = fetch_all_records("Tasks")
-    all_grades = fetch_all_records("Grades")
-    scores_map = {clean_id(r['ID']): float(r.get(task_col, 0)) for i, r in df_input.iterrows()}
-    
-    target_tasks = []
-    other_tasks = []
-    for t in all_tasks:
-        if t['subject'] == subject and t['quarter'] == quarter and t['school_year'] == year and t['test_name'] == test_name: target_tasks.append(t)
-        else: other_tasks.append(t)
-            
-    existing_tasks_map = {clean_id(t['student_id']): t for t in target_tasks}
-    updated_rows = []
-    grade_updates = {}
-    
-    for sid, score in scores_map.items():
-        if sid in existing_tasks_map: row = existing_tasks_map[sid]
-        else: 
-            row = {"uid": f"{sid}_{subject}_{quarter}_{year}_{test_name}", "student_id": sid, "subject": subject, "quarter": quarter, "school_year": year, "test_name": test_name, "raw_total":0}
-            for i in range(1, 11): row[f"t{i}"] = 0
-        
-        try:
-            task_num = int(task_col.replace("Task ", ""))
-            db_col = f"t{task_num}"
-        except: db_col = "t1"
-        
-        row[db_col] = score
-        
-        rt = 0.0
-        for i in range(1, 11): rt += float(row.get(f"t{i}", 0))
-        row['raw_total'] = rt
-        
-        updated_rows.append(row)
-        
-        weighted = 0.0
-        if total_max_score > 0:
-            weighted = (row['raw_total'] / total_max_score) * weight
-            if weighted > weight: weighted = weight
-        grade_updates[sid] = weighted
-        
-    final_tasks = other_tasks + updated_rows
-    overwrite_sheet_data("Tasks", final_tasks)
-    
-    processed_sids = []
-    for g in all_grades:
-        if g['subject'] == subject and g['quarter'] == quarter and g['school_year'] == year:
-            sid = clean_id(g['student_id'])
-            if sid in grade_updates:
-                new_val = grade_updates[sid]
-                if test_name.startswith("Test 1"): g['test1'] = new_val
-                elif test_name.startswith("Test 2"): g['test2'] = new_val
-                elif test_name.startswith("Test 3"): g['test3'] = new_val
-                g['total_score'] = float(g['test1']) + float(g['test2']) + float(g['test3']) + float(g['final_score'])
-                g['recorded_by'] = teacher
-                g['timestamp'] = str(datetime.datetime.now())
-                processed_sids.append(sid)
-                
-    for sid, score in grade_updates.items():
-        if sid not in processed_sids:
-            new_row = {"id": int(time.time())+int(sid), "student_id": sid, "subject": subject, "quarter": quarter, "school_year": year, "test1": 0, "test2": 0, "test3": 0, "final_score": 0, "total_score": score, "recorded_by": teacher, "timestamp": str(datetime.datetime.now())}
-            if test_name.startswith("Test 1"): new_row['test1'] = score
-            elif test_name.startswith("Test 2"): new_row['test2'] = score
-            elif test_name.startswith("Test 3"): new_row['test3'] = score
-            all_grades.append(new_row)
-            
-    overwrite_sheet_data("Grades", all_grades)
-    clear_cache()
+    save_task_scores(subject, quarter, year, test_name, _scores_frame(df_input, {task_no_of(task_col) or 1: task_col}), total_max_score, weight, teacher)
     return True
 
 def save_batch_tasks_and_grades(subject, quarter, year, test_name, task_df, max_score, weight, teacher):
-    all_tasks = fetch_all_records("Tasks")
-    all_grades = fetch_all_records("Grades")
-    all_tasks = [t for t in all_tasks if not (t['subject'] == subject and t['quarter'] == quarter and t['school_year'] == year and t['test_name'] == test_name)]
-    grade_updates = {}
-    
-    for idx, row in task_df.iterrows():
-        sid = clean_id(row['ID'])
-        raw_total = 0.0
-        row_db = {"uid": f"{sid}_{subject}_{quarter}_{year}_{test_name}", "student_id": sid, "subject": subject, "quarter": quarter, "school_year": year, "test_name": test_name}
-        
-        for i in range(1, 11):
-            val = float(row.get(f'Task {i}', 0))
-            row_db[f"t{i}"] = val
-            raw_total += val
-            
-        row_db["raw_total"] = raw_total
-        
-        weighted = 0.0
-        if max_score > 0:
-            weighted = (raw_total / max_score) * weight
-            if weighted > weight: weighted = weight
-        grade_updates[sid] = weighted
-        all_tasks.append(row_db)
-        
-    overwrite_sheet_data("Tasks", all_tasks)
-    
-    processed_sids = []
-    for g in all_grades:
-        if g['subject'] == subject and g['quarter'] == quarter and g['school_year'] == year:
-            sid = clean_id(g['student_id'])
-            if sid in grade_updates:
-                new_val = grade_updates[sid]
-                if test_name.startswith("Test 1"): g['test1'] = new_val
-                elif test_name.startswith("Test 2"): g['test2'] = new_val
-                elif test_name.startswith("Test 3"): g['test3'] = new_val
-                g['total_score'] = float(g['test1']) + float(g['test2']) + float(g['test3']) + float(g['final_score'])
-                g['recorded_by'] = teacher
-                g['timestamp'] = str(datetime.datetime.now())
-                processed_sids.append(sid)
-    for sid, score in grade_updates.items():
-        if sid not in processed_sids:
-            new_row = {"id": int(time.time())+int(sid), "student_id": sid, "subject": subject, "quarter": quarter, "school_year": year, "test1": 0, "test2": 0, "test3": 0, "final_score": 0, "total_score": score, "recorded_by": teacher, "timestamp": str(datetime.datetime.now())}
-            if test_name.startswith("Test 1"): new_row['test1'] = score
-            elif test_name.startswith("Test 2"): new_row['test2'] = score
-            elif test_name.startswith("Test 3"): new_row['test3'] = score
-            all_grades.append(new_row)
-    overwrite_sheet_data("Grades", all_grades)
-    clear_cache()
+    task_cols = {task_no_of(c): c for c in task_df.columns if task_no_of(c)}
+    save_task_scores(subject, quarter, year, test_name, _scores_frame(task_df, task_cols), max_score, weight, teacher)
     return True, "Batch Save Successful"
 
 def save_final_exam_batch(subject, quarter, year, grade_df, max_score, teacher):
-    all_grades = fetch_all_records("Grades")
-    all_tasks = fetch_all_records("Tasks")
-    all_tasks = [t for t in all_tasks if not (t['subject'] == subject and t['quarter'] == quarter and t['school_year'] == year and t['test_name'] == "Final Exam")]
-    grade_updates = {}
-    for idx, row in grade_df.iterrows():
-        sid = clean_id(row['ID'])
-        raw = float(row.get('Raw Score', 0))
-        weighted = 0.0
-        if max_score > 0:
-            weighted = (raw / max_score) * 20.0 
-            if weighted > 20.0: weighted = 20.0
-        grade_updates[sid] = weighted
-        
-        row_db = {"uid": f"{sid}_{subject}_{quarter}_{year}_Final Exam", "student_id": sid, "subject": subject, "quarter": quarter, "school_year": year, "test_name": "Final Exam", "raw_total": raw}
-        for i in range(1, 11): row_db[f"t{i}"] = 0
-        all_tasks.append(row_db)
-        
-    overwrite_sheet_data("Tasks", all_tasks)
-    processed_sids = []
-    for g in all_grades:
-        if g['subject'] == subject and g['quarter'] == quarter and g['school_year'] == year:
-            sid = clean_id(g['student_id'])
-            if sid in grade_updates:
-                g['final_score'] = grade_updates[sid]
-                g['total_score'] = float(g['test1']) + float(g['test2']) + float(g['test3']) + float(g['final_score'])
-                g['recorded_by'] = teacher
-                g['timestamp'] = str(datetime.datetime.now())
-                processed_sids.append(sid)
-    for sid, score in grade_updates.items():
-        if sid not in processed_sids:
-            new_row = {"id": int(time.time()) + int(sid), "student_id": sid, "subject": subject, "quarter": quarter, "school_year": year, "test1": 0, "test2": 0, "test3": 0, "final_score": score, "total_score": score, "recorded_by": teacher, "timestamp": str(datetime.datetime.now())}
-            all_grades.append(new_row)
-    overwrite_sheet_data("Grades", all_grades)
-    clear_cache()
+    # The final exam is a single-task test: its raw score is task 1.
+    save_task_scores(subject, quarter, year, "Final Exam", _scores_frame(grade_df, {1: 'Raw Score'}), max_score, 20.0, teacher)
     return True
 
+# --- CREDENTIALS ---
+PBKDF2_ITERATIONS = 100_000
+
+def staff_principal(username):
+    return f"staff:{str(username).strip().lower()}"
+
+def student_principal(student_id):
+    return f"student:{clean_id(student_id)}"
+
+def hash_password(password, salt=None):
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", str(password).encode(), bytes.fromhex(salt), PBKDF2_ITERATIONS).hex()
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt}${digest}"
+
+def verify_password(password, stored):
+    try:
+        _, iterations, salt, digest = str(stored).split("$")
+        check = hashlib.pbkdf2_hmac("sha256", str(password).encode(), bytes.fromhex(salt), int(iterations)).hex()
+        return hmac.compare_digest(check, digest)
+    except ValueError: return False
+
+def _load_credential_index():
+    # Served locally by the same rule as fetch_records; a failed sheet read raises, so it is never cached.
+    if _serve_local("Credentials"): rows = _read_local("Credentials")
+    else:
+        try:
+            rows = sheet_rows("Credentials", ensure_worksheet(get_cloud_connection(), "Credentials").get_all_records())
+            cloud_call_succeeded()
+        except Exception as e:
+            cloud_call_failed(e)
+            raise
+    return {r['principal']: r['password_hash'] for r in rows}
+
+def get_credential_index():
+    """{principal: password_hash}, rebuilt only when Credentials is written; None when it could not be read.
+    Logins fail closed on None rather than fall back to a possibly stale or seeded local copy."""
+    try: return cached_read("Credentials", ("index",), _load_credential_index)
+    except Exception as e:
+        print(f"Credentials Read Error: {e}")
+        return None
+
+def set_password(principal, password):
+    upsert_records("Credentials", [{"principal": principal, "password_hash": hash_password(password)}])
+
+def _upgrade_plaintext(sheet_name, row, principal):
+    """Moves a password that is still plaintext (e.g. typed into the sheet) into Credentials."""
+    stored = hash_password(norm_key(row['password']))
+    upsert_records("Credentials", [{"principal": principal, "password_hash": stored}])
+    upsert_records(sheet_name, [dict(row, password="")])
+    return stored
+
 # --- LOGIC ---
 def login_staff(username, password):
-    records = fetch_all_records("Users")
-    for row in records:
-        if str(row['username']).lower() == str(username).lower() and str(row['password']) == str(password):
-            return (row['username'], row['password'], row['role'], base64_to_image(row['profile_pic']))
-    return None
+    principal, index = staff_principal(username), get_credential_index()
+    if index is None: return None
+    stored = index.get(principal)
+    # Exact key first; the scan only runs when the case typed differs from the stored username
+    rows = fetch_records("Users", username=str(username).strip()) or [r for r in fetch_all_records("Users") if staff_principal(r['username']) == principal]
+    if not rows: return None
+    row = rows[0]
+    if not stored and str(row.get('password', '')):
+        if str(row['password']) != str(password): return None
+        stored = _upgrade_plaintext("Users", row, principal)
+    if not stored or not verify_password(password, stored): return None
+    return (row['username'], "", row['role'], row['profile_pic'])
 
 def login_student(student_id, password):
-    records = fetch_all_records("Students")
     s_id_in = clean_id(student_id)
-    for row in records:
-        if clean_id(row['student_id']) == s_id_in:
-            if row.get('status', 'Active') == 'Deleted': return None
-            db_pass = str(row['password'])
-            is_valid = False
-            if not db_pass and str(password) == s_id_in: is_valid = True
-            elif str(password) == db_pass: is_valid = True
-            if is_valid: return (row['student_id'], row['student_name'], row['password'], base64_to_image(row['photo']), row.get('status','Active'))
+    for row in fetch_records("Students", student_id=s_id_in):
+        if row.get('status', 'Active') == 'Deleted': return None
+        principal, index = student_principal(s_id_in), get_credential_index()
+        if index is None: return None
+        stored = index.get(principal)
+        if not stored and str(row.get('password', '')):
+            if str(row['password']) != str(password): return None
+            stored = _upgrade_plaintext("Students", row, principal)
+        # Until a password is set (the loaded index has no entry), the student ID is the password
+        is_valid = verify_password(password, stored) if stored else str(password) == s_id_in
+        if is_valid: return (row['student_id'], row['student_name'], "", row['photo'], row.get('status','Active'))
+        return None
     return None
 
 def change_student_password(s_id, new_pass):
-    records = fetch_all_records("Students")
-    for r in records:
-        if clean_id(r['student_id']) == clean_id(s_id): r['password'] = new_pass
-    overwrite_sheet_data("Students", records)
-    clear_cache()
+    set_password(student_principal(s_id), new_pass)
+    changed = [dict(r, password="") for r in fetch_records("Students", student_id=clean_id(s_id)) if r.get('password')]
+    upsert_records("Students", changed)
 
 def register_user(username, password, code):
     if code != SCHOOL_CODE: return False, "❌ Invalid School Code!"
     records = fetch_all_records("Users")
     for r in records:
         if r['username'].lower() == username.lower(): return False, "Taken"
-    records.append({"username": username, "password": password, "role": "Teacher", "profile_pic": ""})
-    overwrite_sheet_data("Users", records)
-    clear_cache()
+    upsert_records("Users", [{"username": username, "password": "", "role": "Teacher", "profile_pic": ""}])
+    set_password(staff_principal(username), password)
     return True, "Success"
 
 def update_teacher_credentials(old_u, new_u, new_p):
+    # Keeping the current password needs its hash; check it can be read before anything is renamed
+    index = {} if new_p else get_credential_index()
+    if index is None: return False, "Could not read credentials, try again"
     users = fetch_all_records("Users")
     if old_u.lower() != new_u.lower():
         for u in users:
             if u['username'].lower() == new_u.lower(): return False, "Username Taken"
-    for u in users:
-        if u['username'] == old_u:
-            u['username'] = new_u
-            u['password'] = new_p
-    subs = fetch_all_records("Subjects")
-    grades = fetch_all_records("Grades")
+    changed_users = [u for u in users if u['username'] == old_u]
+    old_plain = next((norm_key(u['password']) for u in changed_users if u.get('password')), "")
+    for u in changed_users:
+        u['username'] = new_u
+        u['password'] = ""
     if old_u != new_u:
-        for s in subs:
-            if s['teacher_username'] == old_u: s['teacher_username'] = new_u
-        for g in grades:
-            if g['recorded_by'] == old_u: g['recorded_by'] = new_u
-    overwrite_sheet_data("Users", users)
-    overwrite_sheet_data("Subjects", subs)
-    overwrite_sheet_data("Grades", grades)
-    clear_cache()
+        delete_records("Users", [old_u])
+    upsert_records("Users", changed_users)
+    # A blank new password keeps the current one
+    old_principal, new_principal = staff_principal(old_u), staff_principal(new_u)
+    stored = hash_password(new_p or old_plain) if new_p or old_plain else index.get(old_principal)
+    if stored: upsert_records("Credentials", [{"principal": new_principal, "password_hash": stored}])
+    if old_principal != new_principal: delete_records("Credentials", [old_principal])
+    if old_u != new_u:
+        subs = fetch_records("Subjects", teacher_username=old_u)
+        for s in subs: s['teacher_username'] = new_u
+        grades = fetch_records("Grades", recorded_by=old_u)
+        for g in grades: g['recorded_by'] = new_u
+        upsert_records("Subjects", subs)
+        upsert_records("Grades", grades)
     return True, "Updated"
 
 # --- READERS ---
+def get_dashboard_counts(counter):
+    """{bucket: count} of a dashboard counter, e.g. get_dashboard_counts("students_status")["Active"].
+    Read from DashboardCounters; while the sheet is the source of truth they are counted from its rows."""
+    source = next(t for t, (counters, _) in COUNTED_TABLES.items() if counter in counters)
+    def load():
+        if _serve_local(source): return _read_local("DashboardCounters", " WHERE counter = ?", [counter])
+        counts = _count_rows(source, fetch_all_records(source))
+        if source == "Grades": counts = collections.Counter(("subject_students", subject) for _, (subject, _) in counts)
+        return [{"bucket": b, "value": n} for (c, b), n in counts.items() if c == counter]
+    return {r['bucket']: int(r['value']) for r in _cached_rows("DashboardCounters", (counter,), load)}
+
+def count_subject_students(subjects):
+    """Distinct students with grades in any of subjects."""
+    def load():
+        if _serve_local("Grades"):
+            where, params = _where_sql("SubjectStudents", {"subject": subjects})
+            with get_db().connect() as conn: n = conn.execute("SELECT COUNT(DISTINCT student_id) FROM SubjectStudents" + where, params).fetchone()[0]
+        else: n = len({clean_id(g['student_id']) for g in fetch_records("Grades", subject=subjects)})
+        return [{"value": n}]
+    return _cached_rows("DashboardCounters", ("students_of", _filter_key({"subject": subjects})), load)[0]['value']
+
 def get_admin_stats():
-    users = fetch_all_records("Users")
-    studs = fetch_all_records("Students")
-    subs = fetch_all_records("Subjects")
-    active = sum(1 for s in studs if s.get('status') == 'Active')
-    dropped = sum(1 for s in studs if s.get('status') == 'Dropped Out')
-    transferred = sum(1 for s in studs if s.get('status') == 'Transferred')
-    deleted = sum(1 for s in studs if s.get('status') == 'Deleted')
-    return len(users), active, dropped, transferred, deleted, len(subs)
+    status = get_dashboard_counts("students_status")
+    users = sum(get_dashboard_counts("users").values())
+    subs = sum(get_dashboard_counts("subjects").values())
+    return users, status.get('Active', 0), status.get('Dropped Out', 0), status.get('Transferred', 0), status.get('Deleted', 0), subs
 
 def get_all_teachers_with_counts():
-    users = fetch_all_records("Users")
+    users = fetch_records("Users", role="Teacher")
     subs = fetch_all_records("Subjects")
+    counts = {}
+    for s in subs: counts[s['teacher_username']] = counts.get(s['teacher_username'], 0) + 1
     data = []
     for u in users:
-        if u['role'] == 'Teacher':
-            count = sum(1 for s in subs if s['teacher_username'] == u['username'])
-            data.append({'username': u['username'], 'password': u['password'], 'subject_count': count})
+        count = counts.get(u['username'], 0)
+        data.append({'username': u['username'], 'subject_count': count})
     return pd.DataFrame(data).astype(str)
 
 def get_all_students_admin(include_deleted=False):
@@ -629,35 +1834,167 @@ def get_all_students_admin(include_deleted=False):
     if not df.empty and not include_deleted: df = df[df['status'] != 'Deleted']
     return df
 
-def get_attendance_score_data(subject_name):
-    # 1. Fetch data using the app's hybrid (Cloud/Local) loader
-    all_records = fetch_all_records("Attendance")
-    
-    if not all_records:
-        return pd.DataFrame()
-
-    df = pd.DataFrame(all_records)
-    
-    # 2. Filter for the specific subject
-    # Ensure column names match your DB schema
-    if 'subject' not in df.columns: return pd.DataFrame()
-    
-    df = df[df['subject'] == subject_name]
-    
-    if df.empty:
+# --- STUDENT SEARCH ---
+STUDENT_SEARCH_LIMIT = 50
+
+def _search_fold(text):
+    """Case-folded with combining marks dropped, so accents and Thai tone marks or vowel signs never block a match."""
+    text = unicodedata.normalize("NFKD", unicodedata.normalize("NFKC", str(text)).casefold())
+    return "".join(ch for ch in text if not unicodedata.combining(ch) and unicodedata.category(ch) != "Mn")
+
+def _search_tokens(text):
+    # Thai titles are often glued on with a dot ("ด.ช.สมชาย"), so dots split tokens like spaces do.
+    return [t for t in "".join(ch if ch.isalnum() else " " for ch in _search_fold(text)).split() if t]
+
+def _trigrams(token):
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _within_edits(a, b, limit):
+    """True when a and b are at most limit insertions, deletions or substitutions apart."""
+    if abs(len(a) - len(b)) > limit: return False
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1): cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > limit: return False
+        prev = cur
+    return prev[-1] <= limit
+
+class StudentSearchIndex:
+    """Name/ID search over the non-deleted students. Query tokens are matched against the indexed tokens
+    exactly, by prefix (bisect over the sorted tokens), by substring and, failing those, within one or
+    two typos (candidates from a trigram index); every query token must match and results rank by match quality."""
+    EXACT, PREFIX, SUBSTRING, TYPO = 4.0, 3.0, 2.0, 1.0
+
+    def __init__(self, students):
+        self.ids, self.names = [], []
+        postings = collections.defaultdict(set)
+        for s in students:
+            if s.get('status') == 'Deleted': continue
+            doc = len(self.ids)
+            self.ids.append(clean_id(s.get('student_id', '')))
+            self.names.append(str(s.get('student_name', '')))
+            for t in _search_tokens(self.names[doc]) + _search_tokens(self.ids[doc]): postings[t].add(doc)
+        self.postings = dict(postings)
+        self.sorted_tokens = sorted(self.postings)
+        self.grams = collections.defaultdict(set)
+        for t in self.sorted_tokens:
+            for g in _trigrams(t): self.grams[g].add(t)
+
+    def _token_matches(self, q):
+        """{indexed token: match score} for one query token."""
+        found = {}
+        i = bisect.bisect_left(self.sorted_tokens, q)
+        while i < len(self.sorted_tokens) and self.sorted_tokens[i].startswith(q):
+            t = self.sorted_tokens[i]
+            found[t] = self.EXACT if t == q else self.PREFIX
+            i += 1
+        if len(q) >= 3:
+            inner = [self.grams.get(g, set()) for g in _trigrams(q) if g.strip() == g]
+            for t in set.intersection(*inner) if inner else set():
+                if t not in found and q in t: found[t] = self.SUBSTRING
+        if not found and len(q) >= 3:
+            limit = 1 if len(q) <= 5 else 2
+            shared = collections.Counter(t for g in _trigrams(q) for t in self.grams.get(g, ()))
+            for t, _ in shared.most_common(200):
+                if _within_edits(q, t, limit) or _within_edits(q, t[:len(q)], limit): found[t] = self.TYPO
+        return found
+
+    def search(self, query, limit=STUDENT_SEARCH_LIMIT):
+        """student_ids best first."""
+        scores = None
+        for q in _search_tokens(query):
+            best = collections.defaultdict(float)
+            for t, score in self._token_matches(q).items():
+                for doc in self.postings[t]: best[doc] = max(best[doc], score)
+            scores = best if scores is None else {d: v + best[d] for d, v in scores.items() if d in best}
+            if not scores: return []
+        ranked = sorted(scores or {}, key=lambda d: (-scores[d], self.names[d], self.ids[d]))
+        return [self.ids[d] for d in ranked[:limit]]
+
+def get_student_search_index():
+    # Shared by every session; a write to Students invalidates it with the table.
+    return cached_read("StudentSearch", (), lambda: StudentSearchIndex(fetch_all_records("Students")))
+
+def search_students(query, limit=STUDENT_SEARCH_LIMIT):
+    return get_student_search_index().search(query, limit)
+
+# --- ATTENDANCE RANGES ---
+# The live Attendance table holds every school year not yet archived. Archiving moves a past year into
+# its own partition: a SQLite file under ARCHIVE_DIR and, in Cloud mode, a worksheet "Attendance <year>".
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "attendance_archive")
+ARCHIVE_SHEET_PREFIX = "Attendance "
+
+def school_year_dates(year):
+    """First and last date (ISO) of a May-to-April school year like "2025-2026"."""
+    start_year = int(str(year)[:4])
+    return f"{start_year}-05-01", f"{start_year + 1}-04-30"
+
+def term_dates(year, term):
+    """Semester 1 runs May-October, semester 2 November-April."""
+    start, end = school_year_dates(year)
+    return (start, f"{start[:4]}-10-31") if term == 1 else (f"{start[:4]}-11-01", end)
+
+def quarter_dates(year, quarter):
+    """Quarters split the school year into three-month blocks: Q1 May-July ... Q4 February-April."""
+    first = datetime.date(int(str(year)[:4]), 5, 1)
+    start = datetime.date(first.year + (first.month + 3 * (quarter - 1) - 1) // 12, (first.month + 3 * (quarter - 1) - 1) % 12 + 1, 1)
+    nxt = datetime.date(start.year + (start.month + 2) // 12, (start.month + 2) % 12 + 1, 1)
+    return start.isoformat(), (nxt - datetime.timedelta(days=1)).isoformat()
+
+def fetch_attendance(start=None, end=None, **filters):
+    """Attendance rows matching filters (as fetch_records) dated start <= date <= end, either end open.
+    Without a window only the live table is read; archived years are read only when the window reaches them."""
+    if start is None and end is None: return fetch_records("Attendance", **filters)
+    rows = fetch_records("Attendance", date=Between(start, end), **filters)
+    for yr in _archived_years_in(start, end): rows += _archive_rows(yr, dict(filters, date=Between(start, end)))
+    return rows
+
+def _archived_years_in(start, end):
+    if start is None and end is None: return []
+    return [yr for yr in archived_attendance_years()
+            if (end is None or school_year_dates(yr)[0] <= str(end)) and (start is None or school_year_dates(yr)[1] >= str(start))]
+
+def _attendance_totals_until(subject, student_ids, end):
+    """{student_id: [Present, Late, Absent, Excused]} as of the last recorded date <= end (open end: all)."""
+    filters = {"subject": subject, "date": Between(None, end)}
+    if student_ids is not None: filters["student_id"] = list(student_ids)
+    where, params = _where_sql("AttendanceTotals", filters)
+    cols = ", ".join(f"t.{c}" for c in ATTENDANCE_STATUSES)
+    with get_db().connect() as conn:
+        rows = conn.execute(f"""SELECT t.student_id, {cols} FROM AttendanceTotals t
+                                JOIN (SELECT student_id, MAX(date) AS last FROM AttendanceTotals{where} GROUP BY student_id) m
+                                ON t.student_id = m.student_id AND t.date = m.last WHERE t.subject = ?""", params + [subject]).fetchall()
+    return {str(r[0]): list(r[1:]) for r in rows}
+
+def get_attendance_counts(subject_name, student_ids=None, start=None, end=None):
+    """Status counts per student (index student_id, columns ATTENDANCE_STATUSES) for a subject, dated start..end.
+    Served from the running totals (two lookups per student) unless the window reaches an archived year."""
+    def load():
+        if _serve_local("Attendance") and not _archived_years_in(start, end):
+            upto = _attendance_totals_until(subject_name, student_ids, end)
+            before = _attendance_totals_until(subject_name, upto.keys(), (datetime.date.fromisoformat(str(start)) - datetime.timedelta(days=1)).isoformat()) if start is not None else {}
+            return [dict(student_id=sid, **{c: n - b for c, n, b in zip(ATTENDANCE_STATUSES, counts, before.get(sid, [0] * 4))}) for sid, counts in upto.items()]
+        filters = {"subject": subject_name}
+        if student_ids is not None: filters["student_id"] = list(student_ids)
+        days = _attendance_day_counts(fetch_attendance(start, end, **filters))
+        per_student = collections.defaultdict(collections.Counter)
+        for (sid, _, _), n in days.items(): per_student[str(sid)].update(n)
+        return [dict(student_id=sid, **{c: n[c] for c in ATTENDANCE_STATUSES}) for sid, n in per_student.items()]
+    key = ("counts", _filter_key({"subject": subject_name, "student_id": list(student_ids) if student_ids is not None else "*", "date": Between(start, end)}))
+    df = pd.DataFrame(_cached_rows("AttendanceTotals", key, load), columns=["student_id"] + ATTENDANCE_STATUSES)
+    return df.set_index("student_id")
+
+def get_attendance_score_data(subject_name, student_ids=None, start=None, end=None):
+    # 1. Status counts per student for this subject in the window, read off the maintained totals
+    summary = get_attendance_counts(subject_name, student_ids, start, end)
+
+    # 2. Math for the Score (Max 5 points)
+    summary['Total_Classes'] = summary[ATTENDANCE_STATUSES].sum(axis=1)
+    summary = summary[summary['Total_Classes'] > 0].copy()
+    if summary.empty:
         return pd.DataFrame()
-
-    # 3. Calculate Logic
-    # Group by Student ID and count statuses
-    summary = df.groupby('student_id')['status'].value_counts().unstack(fill_value=0)
-    
-    # Ensure columns exist
-    for col in ['Present', 'Late', 'Absent', 'Excused']:
-        if col not in summary.columns:
-            summary[col] = 0
-
-    # 4. Math for the Score (Max 5 points)
-    summary['Total_Classes'] = summary['Present'] + summary['Late'] + summary['Absent'] + summary['Excused']
     
     # Weighted attendance: Present = 1, Late = 0.5
     summary['Weighted_Points'] = summary['Present'] + (summary['Late'] * 0.5)
@@ -672,30 +2009,115 @@ def get_attendance_score_data(subject_name):
 
     return summary
 
+def get_attendance_history(**filters):
+    """Attendance rows matching filters across the live table and every archived year."""
+    rows = fetch_records("Attendance", **filters)
+    for yr in archived_attendance_years(): rows += _archive_rows(yr, filters)
+    return rows
+
+@st.cache_resource
+def get_archive_db(year):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    return LocalDB(os.path.join(ARCHIVE_DIR, f"attendance_{year}.sqlite"))
+
+def _archive_sheet_title(year):
+    return f"{ARCHIVE_SHEET_PREFIX}{year}"
+
+def archived_attendance_years():
+    """School years with an archive partition, here or (Cloud mode) on the spreadsheet."""
+    def load():
+        years = {f[len("attendance_"):-len(".sqlite")] for f in os.listdir(ARCHIVE_DIR) if f.startswith("attendance_") and f.endswith(".sqlite")} if os.path.isdir(ARCHIVE_DIR) else set()
+        sh = get_cloud_connection() if get_data_mode() == 'Cloud' else None
+        if sh:
+            try: years |= {w.title[len(ARCHIVE_SHEET_PREFIX):] for w in sh.worksheets() if w.title.startswith(ARCHIVE_SHEET_PREFIX)}
+            except Exception as e: print(f"Archive List Error: {e}")
+        return [{"year": y} for y in sorted(years)]
+    return [r['year'] for r in _cached_rows("AttendanceArchive", ("years",), load)]
+
+def _archive_rows(year, filters):
+    """Rows of an archived year; a partition missing here is first copied down from its worksheet.
+    The partition is only created once that pull succeeds: a failed or offline read is not cached and is retried."""
+    def load():
+        db = get_archive_db(year)
+        with db.connect() as conn: pulled = _table_exists(conn, "Attendance")
+        if not pulled:
+            sh = get_cloud_connection() if get_data_mode() == 'Cloud' else None
+            if not sh: raise RuntimeError("the year's worksheet is unreachable")
+            rows = sheet_rows("Attendance", sh.worksheet(_archive_sheet_title(year)).get_all_records())
+            with db.transaction() as conn:
+                if not _table_exists(conn, "Attendance"):
+                    _create_table(conn, "Attendance")
+                    _create_indexes(conn)
+                    _insert_rows(conn, "Attendance", rows, "replace")
+        where, params = _where_sql("Attendance", filters)
+        with db.connect() as conn:
+            df = pd.read_sql('SELECT * FROM "Attendance"' + where, conn, params=params)
+        return df.fillna("").to_dict('records')
+    try: return _cached_rows("AttendanceArchive", (year, _filter_key(filters)), load)
+    except Exception as e:
+        print(f"Archive Pull Error ({year}): {e}")
+        return []
+
+def archive_attendance_year(year):
+    """Moves a past school year's rows from the live Attendance table into the year's partition."""
+    if year in get_school_years()[1:]: return False, "Only past school years can be archived."
+    rows = fetch_records("Attendance", date=Between(*school_year_dates(year)))
+    if not rows: return False, f"No live attendance for {year}."
+    cols = table_columns("Attendance")
+    sh = get_cloud_connection() if get_data_mode() == 'Cloud' else None
+    # With a spreadsheet the live sheet is only replaced once the year's worksheet holds the rows
+    if spreadsheet_configured() and not sh: return False, "Archiving needs the spreadsheet connection; try again when online."
+    if sh:
+        # The worksheet is written first: the live rows are only deleted once the partition holds them
+        try:
+            title = _archive_sheet_title(year)
+            try:
+                ws = sh.worksheet(title)
+                have = {norm_key(k) for k in ws.col_values(cols.index("uid") + 1)[1:]}
+                new = [[cell_value(r.get(c)) for c in cols] for r in rows if norm_key(r['uid']) not in have]
+                if new: ws.append_rows(new)
+            except gspread.exceptions.WorksheetNotFound:
+                ws = sh.add_worksheet(title, len(rows) + 1, len(cols))
+                ws.update(range_name="A1", values=[cols] + [[cell_value(r.get(c)) for c in cols] for r in rows])
+            cloud_call_succeeded()
+        except Exception as e:
+            cloud_call_failed(e)
+            return False, f"Archive failed: {e}"
+    with get_archive_db(year).transaction() as conn:
+        if not _table_exists(conn, "Attendance"):
+            _create_table(conn, "Attendance")
+            _create_indexes(conn)
+        _insert_rows(conn, "Attendance", [{c: r.get(c) for c in cols} for r in rows], "replace")
+    # One whole-table push replaces the live worksheet instead of a queued delete per archived row
+    with get_db().transaction() as conn:
+        _local_delete(conn, "Attendance", [r['uid'] for r in rows])
+        if sh: enqueue_sync(conn, "Attendance", [None])
+    invalidate_tables("Attendance", "AttendanceArchive")
+    notify_local_save()
+    return True, f"Archived {len(rows)} attendance records of {year}."
 
 def get_student_details(student_id):
-    records = fetch_all_records("Students")
+    records = fetch_records("Students", student_id=clean_id(student_id))
     for r in records:
-        if clean_id(r['student_id']) == clean_id(student_id): return (r['student_name'], r['grade_level'], r['room'], base64_to_image(r['photo']), r.get('status','Active'))
+        return (r['student_name'], r['grade_level'], r['room'], r['photo'], r.get('status','Active'))
     return None
 
 def get_next_class_no(level, room):
-    records = fetch_all_records("Students")
+    records = fetch_records("Students", grade_level=level, room=room)
     max_no = 0
     for r in records:
-        if r['grade_level'] == level and str(r['room']) == str(room) and r.get('status') != 'Deleted':
+        if r.get('status') != 'Deleted':
             if int(r['class_no']) > max_no: max_no = int(r['class_no'])
     return max_no + 1
 
 def get_class_roster(level, room, only_active=False):
-    records = fetch_all_records("Students")
+    records = fetch_records("Students", grade_level=level, room=room)
     filtered = []
     for r in records:
-        if r['grade_level'] == level and str(r['room']) == str(room):
-            stat = r.get('status', 'Active')
-            if stat == 'Deleted': continue
-            if only_active and stat != 'Active': continue
-            filtered.append(r)
+        stat = r.get('status', 'Active')
+        if stat == 'Deleted': continue
+        if only_active and stat != 'Active': continue
+        filtered.append(r)
     df = pd.DataFrame(filtered)
     if not df.empty:
         df = df.astype(str)
@@ -705,188 +2127,384 @@ def get_class_roster(level, room, only_active=False):
     return df
 
 def get_all_active_students_list():
-    records = fetch_all_records("Students")
-    res = [r for r in records if r.get('status') == 'Active']
-    return pd.DataFrame(res)
+    return pd.DataFrame(fetch_records("Students", status="Active"))
 
 def get_teacher_subjects_full(teacher):
-    records = fetch_all_records("Subjects")
-    res = []
-    for r in records:
-        if r['teacher_username'] == teacher: res.append((r['id'], r['subject_name']))
-    return res
+    records = fetch_records("Subjects", teacher_username=teacher)
+    return [(r['id'], r['subject_name']) for r in records]
 
 def get_subject_student_count(subject_name):
-    grades = fetch_all_records("Grades")
-    return sum(1 for g in grades if g['subject'] == subject_name)
+    return get_dashboard_counts("subject_students").get(subject_name, 0)
 
-def fetch_task_records(subject, quarter, year, test_name):
-    records = fetch_all_records("Tasks")
-    res = {}
-    for r in records:
-        if r['subject'] == subject and r['quarter'] == quarter and r['school_year'] == year and r['test_name'] == test_name:
-            res[clean_id(r['student_id'])] = r
-    return res
-
-def get_grade_record(student_id, subject, quarter, year):
-    records = fetch_all_records("Grades")
-    for r in records:
-        if (clean_id(r['student_id']) == clean_id(student_id) and r['subject'] == subject and r['quarter'] == quarter and r['school_year'] == year):
-            return (r['test1'], r['test2'], r['test3'], r['final_score'], r['total_score'])
-    return None
+def get_student_task_totals(student_id):
+    """One row per test the student has task scores in: the test's fields plus raw_total."""
+    scores = pd.DataFrame(fetch_records("TaskScores", student_id=clean_id(student_id)))
+    if scores.empty: return pd.DataFrame()
+    totals = pd.to_numeric(scores['score'], errors='coerce').fillna(0).groupby(scores['assessment_id']).sum().rename('raw_total')
+    tests = pd.DataFrame(fetch_records("Assessments", assessment_id=list(totals.index)))
+    if tests.empty: return pd.DataFrame()
+    return tests.join(totals, on='assessment_id')
 
 def get_student_full_report(student_id):
-    records = fetch_all_records("Grades")
-    data = [r for r in records if clean_id(r['student_id']) == clean_id(student_id)]
-    return pd.DataFrame(data)
+    return pd.DataFrame(fetch_records("Grades", student_id=clean_id(student_id)))
+
+QUARTERS = ["Q1", "Q2", "Q3", "Q4"]
+GRADE_SCORE_COLS = ['test1', 'test2', 'test3', 'final_score', 'total_score']
+
+def get_class_grade_matrix(subject, year, student_ids):
+    """One row per student, columns like 'Q1_total_score' for every quarter/score pair; NaN where no grade row exists."""
+    recs = fetch_records("Grades", subject=subject, quarter=QUARTERS, school_year=year)
+    g = pd.DataFrame(recs, columns=['student_id', 'quarter'] + GRADE_SCORE_COLS)
+    g['student_id'] = g['student_id'].astype(str).map(clean_id)
+    g[GRADE_SCORE_COLS] = g[GRADE_SCORE_COLS].apply(pd.to_numeric, errors='coerce').fillna(0)
+    g = g.drop_duplicates(['student_id', 'quarter'])
+    wide = g.pivot(index='student_id', columns='quarter', values=GRADE_SCORE_COLS)
+    wide.columns = [f"{qtr}_{col}" for col, qtr in wide.columns]
+    wide = wide.reindex(columns=[f"{qtr}_{col}" for qtr in QUARTERS for col in GRADE_SCORE_COLS])
+    return wide.reindex(pd.Index(student_ids, name='student_id'))
+
+def build_gradebook(subject, year, roster, view):
+    """Gradebook table for a roster: a single quarter, 'Semester 1 Final', 'Semester 2 Final' or 'All Quarters'."""
+    if roster.empty: return pd.DataFrame()
+    ids = roster['student_id'].astype(str).map(clean_id).tolist()
+    out = pd.DataFrame({"ID": roster['student_id'].astype(str).values, "No": roster['class_no'].values, "Name": roster['student_name'].values})
+
+    if view in ("Semester 1 Final", "Semester 2 Final", "All Quarters"):
+        # Totals, GPAs and averages come precomputed from GradeSummary
+        summary = pd.DataFrame(fetch_grade_summary(subject=subject, school_year=year), columns=table_columns("GradeSummary"))
+        summary = summary.drop_duplicates('student_id').set_index('student_id').reindex(ids).reset_index(drop=True)
+        def col(name, as_int=True):
+            vals = pd.to_numeric(summary[name], errors='coerce').fillna(0)
+            return vals.astype(int) if as_int else vals
+        if view == "All Quarters":
+            for qtr in QUARTERS: out[qtr] = col(qtr)
+            out["Year Avg"] = col("year_avg")
+        else:
+            sem = 1 if view == "Semester 1 Final" else 2
+            for qtr in QUARTERS[2 * sem - 2:2 * sem]: out[f"{qtr} (50)"] = col(qtr)
+            out[f"Sem {sem} Final (100)"] = col(f"sem{sem}_total")
+            out["GPA"] = col(f"sem{sem}_gpa", as_int=False)
+    else:
+        m = get_class_grade_matrix(subject, year, ids).reset_index(drop=True)
+        has = m[f"{view}_total_score"].notna()
+        labels = {"test1": "Test 1", "test2": "Test 2", "test3": "Test 3", "final_score": "Final", "total_score": "Total"}
+        for col, label in labels.items():
+            out[label] = m[f"{view}_{col}"].fillna(0).astype(int).astype(object).where(has, "-")
+    return out
+
+# --- GRADING SCALE ---
+# Stored as Config rows (test_name GRADING_SCALE_TEST, one per band: max_score = lowest score of the band,
+# task_name = its grade point). A scale saved for a school year applies until a later year saves its own.
+GRADING_SCALE_TEST = "Grading Scale"
+DEFAULT_GRADING_SCALE = [(80, 4.0), (75, 3.5), (70, 3.0), (65, 2.5), (60, 2.0), (55, 1.5), (50, 1.0), (0, 0.0)]
+
+class GradingScale:
+    """Score bands -> grade points, applied to whole arrays with one np.searchsorted."""
+    def __init__(self, bands, year=None):
+        bands = sorted((float(lo), float(pt)) for lo, pt in bands)
+        self.year = year
+        self.cutoffs = np.array([lo for lo, _ in bands])
+        # Scores below the lowest band earn 0.0
+        self.points = np.array([0.0] + [pt for _, pt in bands])
+
+    def apply(self, scores):
+        return self.points[np.searchsorted(self.cutoffs, np.nan_to_num(np.asarray(scores, dtype=float)), side='right')]
+
+    def bands(self):
+        return list(zip(self.cutoffs[::-1].tolist(), self.points[:0:-1].tolist()))
+
+def grading_scale_key(year):
+    return f"scale_{year}"
+
+def _scale_in_force(rows, year):
+    df = pd.DataFrame(rows)
+    if not df.empty:
+        df = df[df['year'].astype(str) <= str(year)]
+    if df.empty: return GradingScale(DEFAULT_GRADING_SCALE)
+    yr = df['year'].astype(str).max()
+    df = df[df['year'].astype(str) == yr]
+    return GradingScale(zip(pd.to_numeric(df['max_score']), pd.to_numeric(df['task_name'])), year=yr)
+
+def get_grading_scale(year):
+    """The scale in force for a school year: its own, else the latest earlier year's, else the default."""
+    return _scale_in_force(fetch_records("Config", test_name=GRADING_SCALE_TEST), year)
+
+def save_grading_scale(year, bands):
+    """Replaces the year's scale with bands [(lowest score, grade point)]."""
+    bands = [(float(lo), float(pt)) for lo, pt in bands]
+    if not bands: return False, "The scale needs at least one band."
+    if len({lo for lo, _ in bands}) != len(bands): return False, "Each band needs a different lowest score."
+    if any(not 0 <= lo <= 100 for lo, _ in bands): return False, "Lowest scores must be between 0 and 100."
+    aid = grading_scale_key(year)
+    rows = [{"uid": f"{aid}_{lo:g}", "subject": "", "quarter": "", "year": year, "test_name": GRADING_SCALE_TEST,
+             "task_name": f"{pt:g}", "max_score": lo, "assessment_id": aid, "task_no": 0} for lo, pt in bands]
+    old = {r['uid'] for r in fetch_records("Config", assessment_id=aid)} - {r['uid'] for r in rows}
+    if old: delete_records("Config", list(old))
+    upsert_records("Config", rows)
+    return True, "Grading scale saved"
+
+# --- REPORT CARDS ---
+REPORT_CARD_COLUMNS = ["Subject", "Teacher", "Q1", "Q2", "1st Sem Total", "1st Sem GPA", "Q3", "Q4", "2nd Sem Total", "2nd Sem GPA"]
+REPORT_CARD_FIELDS = {"subject": "Subject", "teacher": "Teacher", "sem1_total": "1st Sem Total", "sem1_gpa": "1st Sem GPA", "sem2_total": "2nd Sem Total", "sem2_gpa": "2nd Sem GPA"}
+
+def summarize_grades(grades, scale_for=None):
+    """GradeSummary rows for every (student_id, school_year, subject) in grades, in one grouped pass,
+    in the order the subjects first appear. scale_for(year) gives the GradingScale of a year."""
+    scale_for = scale_for or get_grading_scale
+    df = pd.DataFrame(grades)
+    if df.empty: return pd.DataFrame(columns=table_columns("GradeSummary"))
+    df['student_id'] = df['student_id'].astype(str).map(clean_id)
+    df['total_score'] = pd.to_numeric(df['total_score'], errors='coerce').fillna(0)
+    keys = ['student_id', 'school_year', 'subject']
+    # The first row recorded per subject names the teacher and wins over later duplicates of a quarter
+    teacher = df.groupby(keys, sort=False)['recorded_by'].first()
+    scores = df.drop_duplicates(keys + ['quarter']).pivot(index=keys, columns='quarter', values='total_score')
+    out = scores.reindex(index=teacher.index, columns=QUARTERS).fillna(0.0).reset_index()
+    out['teacher'] = teacher.values
+    out['sem1_total'] = out['Q1'] + out['Q2']
+    out['sem2_total'] = out['Q3'] + out['Q4']
+    # Note: a missing quarter counts as 0 in the simple year average
+    out['year_avg'] = out[QUARTERS].sum(axis=1) / 4
+    out['sem1_gpa'] = out['sem2_gpa'] = 0.0
+    for yr, idx in out.groupby('school_year').groups.items():
+        scale = scale_for(yr)
+        out.loc[idx, 'sem1_gpa'] = scale.apply(out.loc[idx, 'sem1_total'])
+        out.loc[idx, 'sem2_gpa'] = scale.apply(out.loc[idx, 'sem2_total'])
+    return out[table_columns("GradeSummary")]
+
+def fetch_grade_summary(**filters):
+    """GradeSummary rows matching filters on student_id, subject and school_year (as fetch_records).
+    The local table is kept up to date by every local write; while the sheet is the source of truth
+    (Cloud mode, nothing pending) the summary is derived from the fetched Grades rows instead."""
+    def load():
+        if _serve_local("Grades"):
+            where, params = _where_sql("GradeSummary", filters)
+            return _read_local("GradeSummary", where, params)
+        return summarize_grades(fetch_records("Grades", **filters)).to_dict('records')
+    return _cached_rows("GradeSummary", _filter_key(filters), load)
+
+def get_report_cards(**filters):
+    """Report card rows (student_id, school_year and REPORT_CARD_COLUMNS) read from GradeSummary."""
+    df = pd.DataFrame(fetch_grade_summary(**filters), columns=table_columns("GradeSummary"))
+    return df.rename(columns=REPORT_CARD_FIELDS)[["student_id", "school_year"] + REPORT_CARD_COLUMNS]
+
+def render_class_report_cards(path, cards):
+    """Report card worker: one class's workbook, a summary sheet plus one sheet per student.
+    cards: report card records with the student's class_no and student_name, sorted by class_no."""
+    def sheets():
+        head = ["No", "Student ID", "Name"]
+        yield "Summary", head + REPORT_CARD_COLUMNS, ([c['class_no'], c['student_id'], c['student_name']] + [c[k] for k in REPORT_CARD_COLUMNS] for c in cards)
+        by_student = collections.defaultdict(list)
+        for c in cards: by_student[(c['class_no'], c['student_id'])].append(c)
+        for (no, sid), rows in by_student.items():
+            yield f"{no}-{sid}", REPORT_CARD_COLUMNS, ([c[k] for k in REPORT_CARD_COLUMNS] for c in rows)
+    write_workbook(path, sheets())
+    return path
+
+def _report_card_pool():
+    # Threads, not forked processes: forking the multithreaded server can copy held locks
+    # (SQLite pool, sync worker) into children that then deadlock.
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="sgs-report-card")
+
+class ReportCardJob:
+    """Background job writing every student's report card for a school year into per-class
+    workbooks, zipped into one download."""
+    def __init__(self, year, cards, students):
+        self.year = year
+        self.status = "running"
+        self.done = 0
+        self.total = 0
+        self.error = None
+        self.path = None
+        self.started = time.time()
+        threading.Thread(target=self._run, args=(cards, students), name="sgs-report-cards", daemon=True).start()
+
+    def _run(self, cards, students):
+        try:
+            roster = pd.DataFrame(students)
+            roster = roster[roster['status'] != 'Deleted'][['student_id', 'student_name', 'class_no', 'grade_level', 'room']]
+            roster['student_id'] = roster['student_id'].astype(str).map(clean_id)
+            roster['class_no'] = pd.to_numeric(roster['class_no'], errors='coerce').fillna(999).astype(int)
+            cards = cards.merge(roster, on='student_id').sort_values(['grade_level', 'room', 'class_no'], kind='stable')
+            classes = list(cards.groupby(['grade_level', 'room'], sort=False))
+            self.total = len(classes)
+            work_dir = os.path.join(EXPORT_DIR, f"report_cards_{self.year}_{int(self.started)}")
+            os.makedirs(work_dir, exist_ok=True)
+            with _report_card_pool() as pool:
+                futures = [pool.submit(render_class_report_cards, os.path.join(work_dir, f"Report_Cards_{lvl}-{rm}.xlsx"), g.to_dict('records')) for (lvl, rm), g in classes]
+                for f in as_completed(futures):
+                    f.result()
+                    self.done += 1
+            path = f"{work_dir}.zip"
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+                for name in sorted(os.listdir(work_dir)): zf.write(os.path.join(work_dir, name), name)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            self.path, self.status = path, "done"
+        except Exception as e:
+            self.error, self.status = str(e), "failed"
+
+@st.cache_resource
+def get_report_card_jobs():
+    return {}
+
+def start_report_card_job(year):
+    """Starts a bulk job unless one is already running; the data is read here, on the calling thread."""
+    jobs = get_report_card_jobs()
+    if jobs.get("current") and jobs["current"].status == "running": return jobs["current"]
+    jobs["current"] = ReportCardJob(year, get_report_cards(school_year=year), fetch_all_records("Students"))
+    return jobs["current"]
 
 # --- WRITERS (ADMIN) ---
 def delete_teacher(username):
-    users = fetch_all_records("Users")
-    subs = fetch_all_records("Subjects")
-    users = [u for u in users if u['username'] != username]
-    subs = [s for s in subs if s['teacher_username'] != username]
-    overwrite_sheet_data("Users", users)
-    overwrite_sheet_data("Subjects", subs)
-    clear_cache()
+    subs = fetch_records("Subjects", teacher_username=username)
+    delete_records("Users", [username])
+    delete_records("Credentials", [staff_principal(username)])
+    delete_records("Subjects", [s['id'] for s in subs])
 
 def admin_reset_teacher_password(username, new_pass):
-    users = fetch_all_records("Users")
-    for u in users:
-        if u['username'] == username: u['password'] = new_pass
-    overwrite_sheet_data("Users", users)
-    clear_cache()
+    users = fetch_records("Users", username=username)
+    if users: set_password(staff_principal(username), new_pass)
+    upsert_records("Users", [dict(u, password="") for u in users if u.get('password')])
 
 def delete_student_admin(s_id):
-    studs = fetch_all_records("Students")
-    studs = [s for s in studs if clean_id(s['student_id']) != clean_id(s_id)]
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
+    delete_records("Students", [clean_id(s_id)])
+    delete_records("Credentials", [student_principal(s_id)])
 
 def admin_restore_student(s_id):
-    studs = fetch_all_records("Students")
-    for s in studs:
-        if clean_id(s['student_id']) == clean_id(s_id): s['status'] = "Active"
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
+    studs = fetch_records("Students", student_id=clean_id(s_id))
+    for s in studs: s['status'] = "Active"
+    upsert_records("Students", studs)
     return True
 
 def admin_reset_student_password(s_id, new_pass):
-    studs = fetch_all_records("Students")
-    for s in studs:
-        if clean_id(s['student_id']) == clean_id(s_id): s['password'] = new_pass
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
+    studs = fetch_records("Students", student_id=clean_id(s_id))
+    if studs: set_password(student_principal(s_id), new_pass)
+    upsert_records("Students", [dict(s, password="") for s in studs if s.get('password')])
 
 def update_teacher_pic(username, image_bytes):
-    users = fetch_all_records("Users")
-    for u in users:
-        if u['username'] == username: u['profile_pic'] = image_to_base64(image_bytes)
-    overwrite_sheet_data("Users", users)
-    clear_cache()
+    users = fetch_records("Users", username=username)
+    ref = store_photo(image_bytes)
+    for u in users: u['profile_pic'] = ref
+    upsert_records("Users", users)
+    return ref
 
 def update_student_pic(student_id, image_bytes):
-    studs = fetch_all_records("Students")
-    for s in studs:
-        if clean_id(s['student_id']) == clean_id(student_id): s['photo'] = image_to_base64(image_bytes)
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
+    studs = fetch_records("Students", student_id=clean_id(student_id))
+    ref = store_photo(image_bytes)
+    for s in studs: s['photo'] = ref
+    upsert_records("Students", studs)
+    return ref
 
 def add_single_student(s_id, name, no, level, room, status="Active"):
-    studs = fetch_all_records("Students")
     s_id = clean_id(s_id)
-    for s in studs:
-        if clean_id(s['student_id']) == s_id:
-            return False, f"⚠️ ID Found: {s['student_name']} ({s['grade_level']}/{s['room']} - {s['status']})"
-    studs.append({"student_id": s_id, "student_name": name, "class_no": no, "grade_level": level, "room": room, "photo": "", "password": "", "status": status})
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
+    for s in fetch_records("Students", student_id=s_id):
+        return False, f"⚠️ ID Found: {s['student_name']} ({s['grade_level']}/{s['room']} - {s['status']})"
+    upsert_records("Students", [{"student_id": s_id, "student_name": name, "class_no": no, "grade_level": level, "room": room, "photo": "", "password": "", "status": status}])
     return True, f"Added {name}"
 
 def update_student_details(s_id, new_name, new_no, new_status):
-    studs = fetch_all_records("Students")
+    studs = fetch_records("Students", student_id=clean_id(s_id))
     for s in studs:
-        if clean_id(s['student_id']) == clean_id(s_id):
-            s['student_name'] = new_name
-            s['class_no'] = new_no
-            s['status'] = new_status
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
+        s['student_name'] = new_name
+        s['class_no'] = new_no
+        s['status'] = new_status
+    upsert_records("Students", studs)
     return True, "Updated"
 
 def delete_single_student(s_id):
-    studs = fetch_all_records("Students")
-    for s in studs:
-        if clean_id(s['student_id']) == clean_id(s_id): s['status'] = "Deleted"
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
+    studs = fetch_records("Students", student_id=clean_id(s_id))
+    for s in studs: s['status'] = "Deleted"
+    upsert_records("Students", studs)
     return True, "Moved to Bin"
 
 def soft_delete_class_roster(level, room):
-    studs = fetch_all_records("Students")
-    c = 0
-    for s in studs:
-        if s['grade_level'] == level and str(s['room']) == str(room):
-            s['status'] = "Deleted"
-            c += 1
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
+    studs = fetch_records("Students", grade_level=level, room=room)
+    for s in studs: s['status'] = "Deleted"
+    c = len(studs)
+    upsert_records("Students", studs)
     return True, f"Deleted {c}"
 
 def promote_students(from_lvl, from_rm, to_lvl, to_rm):
-    studs = fetch_all_records("Students")
-    c = 0
+    studs = fetch_records("Students", grade_level=from_lvl, room=from_rm, status="Active")
     for s in studs:
-        if s['grade_level'] == from_lvl and str(s['room']) == str(from_rm) and s.get('status') == 'Active':
-            s['grade_level'] = to_lvl
-            s['room'] = to_rm
-            c += 1
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
+        s['grade_level'] = to_lvl
+        s['room'] = to_rm
+    c = len(studs)
+    upsert_records("Students", studs)
     return True, f"Promoted {c}"
 
-def upload_roster(df, level, room):
-    studs = fetch_all_records("Students")
-    existing_ids = [clean_id(s['student_id']) for s in studs]
-    current_max = 0
-    for s in studs:
-        if s['grade_level'] == level and str(s['room']) == str(room) and s.get('status') != 'Deleted':
-             if int(s['class_no']) > current_max: current_max = int(s['class_no'])
-    current_number = current_max + 1
-    added = 0
-    errors = []
-    for index, row in df.iterrows():
-        s_id = clean_id(row['ID'])
-        if s_id in existing_ids: errors.append(f"Skipped {s_id}"); continue
-        studs.append({"student_id": s_id, "student_name": str(row['Name']), "class_no": current_number, "grade_level": level, "room": room, "photo": "", "password": "", "status": "Active"})
-        existing_ids.append(s_id)
-        current_number += 1
-        added += 1
-    overwrite_sheet_data("Students", studs)
-    clear_cache()
-    return True, f"Uploaded {added}", errors
+ROSTER_COLUMNS = ["ID", "Name"]
+ROSTER_CHUNK_ROWS = 500
+
+def read_roster_chunks(file, name, chunksize=ROSTER_CHUNK_ROWS):
+    """Streams an uploaded CSV/XLSX roster as DataFrames of up to chunksize rows, all values as text."""
+    if name.lower().endswith(".csv"):
+        yield from pd.read_csv(file, chunksize=chunksize, dtype=str, keep_default_na=False)
+        return
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = [str(h).strip() if h is not None else "" for h in next(rows, ())]
+        batch = []
+        for r in rows:
+            batch.append(["" if v is None else str(v) for v in r])
+            if len(batch) == chunksize:
+                yield pd.DataFrame(batch, columns=header)
+                batch = []
+        if batch: yield pd.DataFrame(batch, columns=header)
+    finally:
+        wb.close()
+
+def import_roster(chunks, level, room, progress=None):
+    """Adds the students of a roster upload to a class. Each chunk is checked as a whole: blank IDs or names,
+    IDs repeated in the file and IDs already registered are rejected. The accepted rows are numbered after
+    the class's last number and saved in one transaction. progress(rows_checked) is called after each chunk.
+    Returns (ok, message, report): one report row (Row, ID, Name, Error) per rejected file row."""
+    seen = set()
+    new_studs, problems = [], []
+    next_no = get_next_class_no(level, room)
+    checked = read = 0
+    for chunk in chunks:
+        missing = [c for c in ROSTER_COLUMNS if c not in chunk.columns]
+        if missing: return False, f"Missing column(s): {', '.join(missing)}", pd.DataFrame(columns=["Row", "ID", "Name", "Error"])
+        rows = pd.RangeIndex(read + 2, read + 2 + len(chunk))  # file line numbers, after the header
+        read += len(chunk)
+        # All-empty rows (e.g. trailing spreadsheet rows) are not roster entries
+        filled = (chunk.fillna("").astype(str).apply(lambda c: c.str.strip()) != "").any(axis=1).values
+        chunk, rows = chunk[filled], rows[filled]
+        # Same normalization as clean_id, over the whole column
+        ids = chunk['ID'].astype(str).str.strip().str.replace('.0', '', regex=False)
+        names = chunk['Name'].astype(str).str.strip()
+        checked += len(chunk)
+        existing = {clean_id(r['student_id']): r for r in fetch_records("Students", student_id=ids[ids != ""].unique().tolist())}
+        error = pd.Series("", index=chunk.index)
+        error[ids.isin(existing)] = [f"ID already registered: {existing[i]['student_name']} ({existing[i]['grade_level']}/{existing[i]['room']} - {existing[i]['status']})" for i in ids[ids.isin(existing)]]
+        error[ids.duplicated() | ids.isin(seen)] = "Duplicate ID in file"
+        error[names == ""] = "Missing name"
+        error[ids == ""] = "Missing ID"
+        ok = error == ""
+        seen.update(ids[ok])
+        new_studs += [{"student_id": i, "student_name": n, "class_no": next_no + k, "grade_level": level, "room": room, "photo": "", "password": "", "status": "Active"}
+                      for k, (i, n) in enumerate(zip(ids[ok], names[ok]))]
+        next_no += int(ok.sum())
+        problems.append(pd.DataFrame({"Row": rows[~ok.values], "ID": ids[~ok].values, "Name": names[~ok].values, "Error": error[~ok].values}))
+        if progress: progress(checked)
+    upsert_records("Students", new_studs)
+    report = pd.concat(problems, ignore_index=True) if problems else pd.DataFrame(columns=["Row", "ID", "Name", "Error"])
+    return True, f"Uploaded {len(new_studs)} of {checked}", report
 
 def add_subject(teacher, subject):
-    subs = fetch_all_records("Subjects")
-    for r in subs:
-        if r['teacher_username'] == teacher and r['subject_name'] == subject: return False, "Duplicate"
-    subs.append({"id": int(time.time()), "teacher_username": teacher, "subject_name": subject})
-    overwrite_sheet_data("Subjects", subs)
-    clear_cache()
+    if fetch_records("Subjects", teacher_username=teacher, subject_name=subject): return False, "Duplicate"
+    upsert_records("Subjects", [{"id": new_row_id(), "teacher_username": teacher, "subject_name": subject}])
     return True, "Added"
 
 def delete_subject(sub_id):
-    subs = fetch_all_records("Subjects")
-    subs = [s for s in subs if str(s['id']) != str(sub_id)]
-    overwrite_sheet_data("Subjects", subs)
-    clear_cache()
+    delete_records("Subjects", [sub_id])
 
 def update_subject(sub_id, new_name):
-    subs = fetch_all_records("Subjects")
-    for s in subs:
-        if str(s['id']) == str(sub_id): s['subject_name'] = new_name
-    overwrite_sheet_data("Subjects", subs)
-    clear_cache()
+    subs = fetch_records("Subjects", id=sub_id)
+    for s in subs: s['subject_name'] = new_name
+    upsert_records("Subjects", subs)
     return True
 
 # --- UI COMPONENTS ---
@@ -956,6 +2574,48 @@ def login_screen():
                         time.sleep(0.5); st.rerun()
                     else: st.error("Invalid ID or Password")
 
+def show_photo(ref, size, width, caption=None):
+    """Renders a photo thumbnail; returns False if there is none to show."""
+    if st.get_option("server.enableStaticServing"):
+        jpg = photo_url(ref, size, "jpg")
+        if not jpg: return False
+        st.markdown(f"<picture><source srcset='{photo_url(ref, size, 'webp')}' type='image/webp'><img src='{jpg}' width='{width}' style='border-radius: 10px;'></picture>", unsafe_allow_html=True)
+        if caption: st.caption(caption)
+        return True
+    path = photo_thumbnail(ref, size)
+    if not path: return False
+    st.image(path, width=width, caption=caption)
+    return True
+
+def format_report_card(cards):
+    """Display strings for one school year's get_report_cards rows."""
+    df = cards[REPORT_CARD_COLUMNS].copy()
+    for c in ["Q1", "Q2", "1st Sem Total", "Q3", "Q4", "2nd Sem Total"]: df[c] = df[c].map(fmt_score)
+    for c in ["1st Sem GPA", "2nd Sem GPA"]: df[c] = df[c].map("{:.1f}".format)
+    return df
+
+def show_report_card(cards):
+    """Renders one school year's report card table; returns the formatted frame for downloads."""
+    df_display = format_report_card(cards)
+    st.dataframe(
+        df_display,
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            "Subject": st.column_config.TextColumn("Subject", width="medium"),
+            "Teacher": st.column_config.TextColumn("Teacher", width="small"),
+            "Q1": st.column_config.TextColumn("Q1", width="small"),
+            "Q2": st.column_config.TextColumn("Q2", width="small"),
+            "1st Sem Total": st.column_config.TextColumn("Sem 1 Score", width="small", help="Sum of Q1 + Q2"),
+            "1st Sem GPA": st.column_config.TextColumn("Sem 1 GPA", width="small"),
+            "Q3": st.column_config.TextColumn("Q3", width="small"),
+            "Q4": st.column_config.TextColumn("Q4", width="small"),
+            "2nd Sem Total": st.column_config.TextColumn("Sem 2 Score", width="small", help="Sum of Q3 + Q4"),
+            "2nd Sem GPA": st.column_config.TextColumn("Sem 2 GPA", width="small"),
+        }
+    )
+    return df_display
+
 def sidebar_menu():
     if 'uploader_key' not in st.session_state: st.session_state.uploader_key = 0
     with st.sidebar:
@@ -964,10 +2624,7 @@ def sidebar_menu():
         
         # Profile Header
         st.markdown("<div style='text-align: center;'>", unsafe_allow_html=True)
-        pic = user_data[3]
-        if pic: 
-            st.image(Image.open(io.BytesIO(pic)), width=100)
-        else: 
+        if not show_photo(user_data[3], THUMB_SIZES["md"], 100):
             st.image("https://cdn-icons-png.flaticon.com/512/1995/1995539.png" if role != "Student" else "https://cdn-icons-png.flaticon.com/512/3237/3237472.png", width=100)
         st.markdown("</div>", unsafe_allow_html=True)
         
@@ -980,8 +2637,8 @@ def sidebar_menu():
                 up = st.file_uploader("Up", type=['jpg','png'], label_visibility="collapsed", key=f"t_up_{ukey}")
                 if up:
                     img_bytes = up.getvalue()
-                    update_teacher_pic(user_data[0], img_bytes)
-                    new_user_data = (user_data[0], user_data[1], user_data[2], img_bytes)
+                    ref = update_teacher_pic(user_data[0], img_bytes)
+                    new_user_data = (user_data[0], user_data[1], user_data[2], ref)
                     st.session_state.user = new_user_data
                     st.toast("✅ Photo Updated!")
                     st.session_state.uploader_key += 1
@@ -990,13 +2647,19 @@ def sidebar_menu():
         st.markdown("---")
         
         if role == "Admin":
-            menu = st.radio("Navigation", ["Dashboard", "👥 Manage Teachers", "🎓 Manage Students"])
+            menu = st.radio("Navigation", ["Dashboard", "👥 Manage Teachers", "🎓 Manage Students", "📑 Report Cards", "⚖️ Grading Scale"])
         elif role == "Teacher":
             menu = st.radio("Navigation", ["Dashboard","📋 Attendance", "📂 Student Roster", "📝 Input Grades", "📊 Gradebook", "👤 Student Record", "⚙️ Settings"])
         else:
             menu = st.radio("Navigation", ["📊 My Attendance","📜 My Grades", "⚙️ Settings"])
         
         st.markdown("---")
+        depth, lag, err = get_sync_status()
+        if depth:
+            st.caption(f"☁️ {depth} change(s) waiting to sync · oldest {int(lag)}s ago")
+            if err: st.caption(f"⚠️ Last sync error: {err[:80]}")
+        else:
+            st.caption("☁️ All changes synced")
         if st.button("🚪 Log Out", use_container_width=True):
             st.session_state.logged_in = False
             st.rerun()
@@ -1012,30 +2675,15 @@ def page_dashboard():
     
     # 1. FETCH DATA
     subs = get_teacher_subjects_full(user)
-    all_active_students = get_all_active_students_list()
-    total_system_students = len(all_active_students)
-    
-    # FETCH GRADES FOR COUNTING
-    # We fetch all grades once to accurately count unique students
-    all_grades = fetch_all_records("Grades")
-    
-    subject_details = []
-    unique_student_ids_overall = set()
+    active_by_level = get_dashboard_counts("active_level")
+    total_system_students = sum(active_by_level.values())
     
-    for s_id, s_name in subs:
-        # Filter grades for this subject
-        s_grades = [g for g in all_grades if g['subject'] == s_name]
-        
-        # Count unique students for this subject (ignoring multiple quarters)
-        unique_s_ids = set(clean_id(g['student_id']) for g in s_grades)
-        
-        cnt = len(unique_s_ids)
-        unique_student_ids_overall.update(unique_s_ids)
-        
-        subject_details.append((s_id, s_name, cnt))
+    # COUNTS: unique students per subject (ignoring multiple quarters) are kept up to date on every grade write
+    subject_counts = get_dashboard_counts("subject_students")
+    subject_details = [(s_id, s_name, subject_counts.get(s_name, 0)) for s_id, s_name in subs]
         
     # Total unique students across all subjects
-    my_total_students = len(unique_student_ids_overall)
+    my_total_students = count_subject_students([s_name for _, s_name in subs])
         
     # 2. METRICS ROW
     c1, c2, c3 = st.columns(3)
@@ -1052,9 +2700,8 @@ def page_dashboard():
     
     with col_chart:
         st.subheader("📈 Student Distribution")
-        if not all_active_students.empty:
-            chart_data = all_active_students['grade_level'].value_counts().reset_index()
-            chart_data.columns = ['Grade Level', 'Count']
+        if active_by_level:
+            chart_data = pd.DataFrame(list(active_by_level.items()), columns=['Grade Level', 'Count'])
             
             c = alt.Chart(chart_data).mark_bar().encode(
                 x='Grade Level',
@@ -1108,6 +2755,25 @@ def page_admin_dashboard():
     st.markdown("### Quick Actions")
     st.info("💡 To manage accounts, use the sidebar menu.")
 
+    with st.expander("🗃️ Archive Attendance"):
+        st.caption("Moves a past school year's attendance out of the live table into its own archive. Reports that cover that year still read it.")
+        past_years = get_school_years()[:1]
+        for _ in range(4): past_years.append(f"{int(past_years[-1][:4]) - 1}-{past_years[-1][:4]}")
+        arc_year = st.selectbox("School Year", past_years, key="archive_year")
+        if st.button("🗃️ Archive Year"):
+            with st.spinner("Archiving..."):
+                ok, msg = archive_attendance_year(arc_year)
+            if ok: st.success(msg)
+            else: st.warning(msg)
+        archived = archived_attendance_years()
+        if archived: st.caption("Archived: " + ", ".join(archived))
+
+    with st.expander("🗄️ Read Cache"):
+        stats = get_table_cache().stats()
+        if stats:
+            st.dataframe(pd.DataFrame([{"Table": t, "Hits": h, "Misses": m, "Hit Rate": f"{h / (h + m):.0%}" if h + m else "-", "Version": v} for t, (h, m, v) in stats.items()]), hide_index=True, use_container_width=True)
+        else: st.caption("No cached reads yet.")
+
 
 def page_admin_manage_teachers():
     st.title("👥 Manage Teachers")
@@ -1173,6 +2839,48 @@ def page_admin_manage_students():
                 admin_restore_student(sid_only); st.success(f"Student {sid_only} restored!"); time.sleep(1.5); st.rerun()
         else: st.info("Bin is empty.")
 
+def page_admin_report_cards():
+    st.title("📑 Report Cards")
+    st.markdown("Generate report cards for every student in the school: one workbook per class, downloaded as a single zip.")
+    school_years = get_school_years()
+    yr = st.selectbox("School Year", school_years, index=1 if len(school_years) > 1 else 0)
+    job = get_report_card_jobs().get("current")
+    running = job is not None and job.status == "running"
+    if st.button("🚀 Generate All Report Cards", type="primary", disabled=running):
+        start_report_card_job(yr)
+        st.rerun()
+
+    if job is None: return
+    if running:
+        st.progress(job.done / job.total if job.total else 0.0, text=f"Rendering {job.year}: {job.done}/{job.total} classes...")
+        time.sleep(1)
+        st.rerun()
+    elif job.status == "done" and os.path.exists(job.path):
+        st.success(f"✅ Report cards for {job.year} ready ({job.total} classes, {time.strftime('%H:%M', time.localtime(job.started))}).")
+        with open(job.path, "rb") as f:
+            st.download_button("⬇️ Download Report Cards (.zip)", f, file_name=f"Report_Cards_{job.year}.zip", mime="application/zip")
+    elif job.status == "failed":
+        st.error(f"Generation failed: {job.error}")
+
+def page_admin_grading_scale():
+    st.title("⚖️ Grading Scale")
+    st.markdown("Semester scores (out of 100) are converted to grade points with this scale. A scale saved for a school year is used from that year on.")
+    school_years = get_school_years()
+    yr = st.selectbox("School Year", school_years, index=1 if len(school_years) > 1 else 0)
+    scale = get_grading_scale(yr)
+    if scale.year is None: st.caption("Using the default scale.")
+    elif scale.year != yr: st.caption(f"Using the scale saved for {scale.year}.")
+    df = pd.DataFrame(scale.bands(), columns=["Lowest Score", "Grade Point"])
+    edited = st.data_editor(df, num_rows="dynamic", hide_index=True, use_container_width=True, key=f"scale_{yr}",
+                            column_config={"Lowest Score": st.column_config.NumberColumn(min_value=0, max_value=100),
+                                           "Grade Point": st.column_config.NumberColumn(min_value=0, format="%.1f")})
+    if st.button("💾 Save Scale", type="primary"):
+        ok, msg = save_grading_scale(yr, edited.dropna().itertuples(index=False, name=None))
+        if ok:
+            st.success(f"✅ {msg} for {yr}")
+            time.sleep(1); st.rerun()
+        else: st.error(msg)
+
 def page_roster():
     st.title("📂 Student Roster")
     c1, c2 = st.columns(2)
@@ -1188,7 +2896,12 @@ def page_roster():
                 if val == 'Active': return 'color: green; font-weight: bold'
                 if val == 'Deleted': return 'color: gray; text-decoration: line-through'
                 return 'color: red; font-weight: bold'
-            st.dataframe(curr[['class_no','student_id','student_name', 'status']].style.map(highlight_status, subset=['status']), hide_index=True, width="stretch")
+            cols, col_config = ['class_no','student_id','student_name', 'status'], {}
+            if st.get_option("server.enableStaticServing") and 'photo' in curr.columns:
+                prepare_thumbnails(curr['photo'], THUMB_SIZES["sm"])
+                curr['Photo'] = [photo_url(p, THUMB_SIZES["sm"]) for p in curr['photo']]
+                cols, col_config = ['Photo'] + cols, {"Photo": st.column_config.ImageColumn(width="small")}
+            st.dataframe(curr[cols].style.map(highlight_status, subset=['status']), column_config=col_config, hide_index=True, width="stretch")
         else:
             st.info("This class is empty.")
 
@@ -1214,12 +2927,19 @@ def page_roster():
             up_file = st.file_uploader("Excel/CSV", type=['xlsx','csv'], key="roster_uploader")
             if up_file and st.button("Upload File"):
                 try:
-                    df = pd.read_csv(up_file) if up_file.name.endswith('.csv') else pd.read_excel(up_file)
-                    ok, msg, errs = upload_roster(df, level, room)
-                    if ok: st.success(msg)
-                    if errs: st.error(f"{len(errs)} Errors: " + ", ".join(errs[:5]) + "...")
-                    time.sleep(1.5); st.rerun()
+                    status = st.empty()
+                    ok, msg, report = import_roster(read_roster_chunks(up_file, up_file.name), level, room, progress=lambda n: status.caption(f"Checked {n} rows..."))
+                    st.session_state.roster_report = (level, room, ok, msg, report)
+                    st.rerun()
                 except Exception as e: st.error(str(e))
+            if st.session_state.get('roster_report', (None, None))[:2] == (level, room):
+                _, _, ok, msg, report = st.session_state.roster_report
+                if ok: st.success(msg)
+                else: st.error(msg)
+                if not report.empty:
+                    st.warning(f"{len(report)} row(s) not imported")
+                    st.dataframe(report, hide_index=True, width="stretch")
+                    st.download_button("⬇️ Error Report", report.to_csv(index=False).encode('utf-8'), "roster_errors.csv", "text/csv")
     
     with t3:
         st.markdown("### Edit & Transfer")
@@ -1364,11 +3084,10 @@ def page_input_grades():
         
         col_sel, col_add = st.columns([4, 1])
         with col_add:
-            if active_count < 10:
-                if st.button("➕ Add Task", use_container_width=True):
-                    next_t = active_count + 1
-                    save_task_max_score(subj, q, yr, test_name, f"Task {next_t}", 0)
-                    st.rerun()
+            if st.button("➕ Add Task", use_container_width=True):
+                next_t = active_count + 1
+                save_task_max_score(subj, q, yr, test_name, f"Task {next_t}", 0)
+                st.rerun()
         
         with col_sel:
             options = [f"Task {i}" for i in range(1, active_count + 1)]
@@ -1379,32 +3098,16 @@ def page_input_grades():
 
         if task_choice == "All Tasks (Overview)":
             st.info(f"Viewing all tasks for {test_name}. Total Max Score: {int(total_test_max)}")
-            existing_tasks = fetch_task_records(subj, q, yr, test_name)
-            editor_data = []
-            
-            for index, row in roster.iterrows():
-                sid = str(row['student_id'])
-                t_rec = existing_tasks.get(sid, {})
-                raw_sum = 0.0
-                row_data = {"No": row['class_no'], "ID": sid, "Name": row['student_name']}
-                
-                for i in range(1, active_count + 1):
-                    val = t_rec.get(f't{i}') or t_rec.get(f'Task {i}') or t_rec.get(f'task{i}') or 0
-                    val = float(val)
-                    row_data[f"Task {i}"] = int(val) 
-                    raw_sum += val
-                
-                w_score = 0.0
-                if total_test_max > 0:
-                    w_score = (raw_sum / total_test_max) * weight
-                    if w_score > weight: w_score = weight
-                
-                # --- CHANGE 1: Round Weighted Score to Integer ---
-                row_data["Total Raw"] = int(raw_sum)
-                row_data["Weighted"] = int(round(w_score)) 
-                editor_data.append(row_data)
+            df_editor = pd.DataFrame({"No": roster['class_no'].values, "ID": roster['student_id'].astype(str).values, "Name": roster['student_name'].values})
+            task_scores = get_task_score_matrix(subj, q, yr, test_name).reindex(index=df_editor['ID'], columns=range(1, active_count + 1)).fillna(0)
+            for i in range(1, active_count + 1):
+                df_editor[f"Task {i}"] = task_scores[i].astype(int).values
+            raw_sum = task_scores.sum(axis=1).values
+            w_score = (raw_sum / total_test_max * weight).clip(max=weight) if total_test_max > 0 else raw_sum * 0.0
             
-            df_editor = pd.DataFrame(editor_data)
+            # --- CHANGE 1: Round Weighted Score to Integer ---
+            df_editor["Total Raw"] = raw_sum.astype(int)
+            df_editor["Weighted"] = w_score.round().astype(int)
             
             # --- CHANGE 2: Configure Column to display as Integer (%d) ---
             col_config = {
@@ -1452,27 +3155,10 @@ def page_input_grades():
             if new_max <= 0:
                 st.warning(f"⚠️ Set Max Score > 0 to enable grading.")
             else:
-                editor_data = []
-                t_num = int(task_choice.split(" ")[1])
-                keys_to_check = [f"t{t_num}", f"Task {t_num}", f"task{t_num}"]
-                existing_tasks = fetch_task_records(subj, q, yr, test_name)
-                
-                for index, row in roster.iterrows():
-                    sid = str(row['student_id'])
-                    t_rec = existing_tasks.get(sid, {})
-                    current_score = 0
-                    for k in keys_to_check:
-                        if k in t_rec:
-                            current_score = float(t_rec[k])
-                            break
-                    editor_data.append({
-                        "No": row['class_no'], 
-                        "ID": sid, 
-                        "Name": row['student_name'],
-                        task_choice: int(current_score)
-                    })
-                
-                df_editor = pd.DataFrame(editor_data)
+                t_num = task_no_of(task_choice)
+                df_editor = pd.DataFrame({"No": roster['class_no'].values, "ID": roster['student_id'].astype(str).values, "Name": roster['student_name'].values})
+                task_scores = get_task_score_matrix(subj, q, yr, test_name).reindex(index=df_editor['ID'], columns=[t_num]).fillna(0)
+                df_editor[task_choice] = task_scores[t_num].astype(int).values
                 col_config = {
                     "No": st.column_config.NumberColumn(disabled=True, width="small"),
                     "ID": st.column_config.TextColumn(disabled=True),
@@ -1496,28 +3182,13 @@ def page_input_grades():
     elif "Final" in selected_tab:
         st.markdown("### 🏁 Final Exam")
         max_final = st.number_input("Perfect Score", min_value=1.0, value=50.0)
-        existing_tasks = fetch_task_records(subj, q, yr, "Final Exam")
-        final_data = []
-        for index, row in roster.iterrows():
-            sid = str(row['student_id'])
-            t_rec = existing_tasks.get(sid, {})
-            raw_val = float(t_rec.get('raw_total') or t_rec.get('Raw Score') or t_rec.get('score') or 0)
-            
-            w_val = 0.0
-            if max_final > 0:
-                w_val = (raw_val / max_final) * 20.0
-                if w_val > 20.0: w_val = 20.0
-            
-            # --- CHANGE 3: Final Exam Weighted Score -> Whole Number ---
-            final_data.append({
-                "No": row['class_no'], 
-                "ID": sid, 
-                "Name": row['student_name'], 
-                "Raw Score": int(raw_val), 
-                "Weighted (20%)": int(round(w_val)) # Rounded Integer
-            })
+        df_final = pd.DataFrame({"No": roster['class_no'].values, "ID": roster['student_id'].astype(str).values, "Name": roster['student_name'].values})
+        raw_val = get_task_score_matrix(subj, q, yr, "Final Exam").sum(axis=1).reindex(df_final['ID']).fillna(0).values
+        w_val = (raw_val / max_final * 20.0).clip(max=20.0)
         
-        df_final = pd.DataFrame(final_data)
+        # --- CHANGE 3: Final Exam Weighted Score -> Whole Number ---
+        df_final["Raw Score"] = raw_val.astype(int)
+        df_final["Weighted (20%)"] = w_val.round().astype(int) # Rounded Integer
         with st.form("final_form"):
             edited_final = st.data_editor(
                 df_final, 
@@ -1556,14 +3227,12 @@ def page_input_grades():
         upload_max_score = st.number_input(f"Total Max Raw Score for {target_test}", min_value=1.0, value=50.0)
         
         if st.button("⬇️ Download Template"):
-            tmp = roster[['class_no', 'student_id', 'student_name']].copy()
-            tmp = tmp.rename(columns={'student_id': 'ID', 'student_name': 'Name'})
-            for i in range(1, 11): tmp[f'Task {i}'] = 0
-            
-            out = io.BytesIO()
-            with pd.ExcelWriter(out, engine='xlsxwriter') as writer:
-                tmp.to_excel(writer, index=False)
-            st.download_button("Download .xlsx", out.getvalue(), "template.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            n_tasks = max(10, get_enabled_tasks_count(subj, q, yr, target_test))
+            def template_sheets():
+                rows = ([r.class_no, r.student_id, r.student_name] + [0] * n_tasks for r in roster.itertuples())
+                yield "Sheet1", ["class_no", "ID", "Name"] + [f"Task {i}" for i in range(1, n_tasks + 1)], rows
+            path = export_workbook(("template", subj, q, yr, lvl, rm, n_tasks), ["Students"], template_sheets)
+            download_workbook("Download .xlsx", path, "template.xlsx")
             
         up_file = st.file_uploader("Upload Excel", type=['xlsx'])
         if up_file and st.button("Process Upload"):
@@ -1614,89 +3283,11 @@ def page_gradebook():
         st.info("No students found in this class.")
         return
         
-    data = []
-
-    # --- HELPER: Get score as int or 0 ---
-    def get_q_score(sid, subj, qtr, year):
-        rec = get_grade_record(sid, subj, qtr, year)
-        if rec:
-            return int(float(rec[4])) # Return Total Score as int
-        return 0
-
-    # --- LOGIC BRANCHES ---
-    
-    # A. SEMESTER 1 FINAL (Q1 + Q2)
-    if q == "Semester 1 Final":
-        for idx, row in roster.iterrows():
-            sid = str(row['student_id'])
-            s1 = get_q_score(sid, s, "Q1", yr)
-            s2 = get_q_score(sid, s, "Q2", yr)
-            sem_total = s1 + s2
-            
-            data.append({
-                "ID": sid, "No": row['class_no'], "Name": row['student_name'], 
-                "Q1 (50)": s1, 
-                "Q2 (50)": s2, 
-                "Sem 1 Final (100)": sem_total
-            })
-
-    # B. SEMESTER 2 FINAL (Q3 + Q4)
-    elif q == "Semester 2 Final":
-        for idx, row in roster.iterrows():
-            sid = str(row['student_id'])
-            s3 = get_q_score(sid, s, "Q3", yr)
-            s4 = get_q_score(sid, s, "Q4", yr)
-            sem_total = s3 + s4
-            
-            data.append({
-                "ID": sid, "No": row['class_no'], "Name": row['student_name'], 
-                "Q3 (50)": s3, 
-                "Q4 (50)": s4, 
-                "Sem 2 Final (100)": sem_total
-            })
-
-    # C. ALL QUARTERS SUMMARY
-    elif q == "All Quarters":
-        for idx, row in roster.iterrows():
-            sid = str(row['student_id'])
-            # Get all scores
-            sc = [get_q_score(sid, s,qx, yr) for qx in ["Q1","Q2","Q3","Q4"]]
-            # Calculate Year Average (Simple average of the 4 totals)
-            # Or if you want (Sem1 + Sem2) / 2, it's mathematically the same as Sum/4
-            # We filter out 0s if you don't want to penalize future quarters, 
-            # BUT usually for a yearly summary, we just show what we have.
-            
-            # Note: If a quarter is missing, it counts as 0 in this logic.
-            year_total = sum(sc) 
-            year_avg = int(year_total / 4) # Simple Avg
-
-            data.append({
-                "ID": sid, "No": row['class_no'], "Name": row['student_name'], 
-                "Q1": sc[0], "Q2": sc[1], "Q3": sc[2], "Q4": sc[3], 
-                "Year Avg": year_avg
-            })
-
-    # D. SINGLE QUARTER VIEW (Detailed)
-    else:
-        for idx, row in roster.iterrows():
-            sid = str(row['student_id'])
-            rec = get_grade_record(sid, s, q, yr)
-            if rec:
-                t1, t2, t3, fin, tot = rec
-                data.append({
-                    "ID": sid, "No": row['class_no'], "Name": row['student_name'], 
-                    "Test 1": int(float(t1)), "Test 2": int(float(t2)), "Test 3": int(float(t3)), 
-                    "Final": int(float(fin)), "Total": int(float(tot))
-                })
-            else:
-                 data.append({
-                     "ID": sid, "No": row['class_no'], "Name": row['student_name'], 
-                     "Test 1": "-", "Test 2": "-", "Test 3": "-", "Final": "-", "Total": "-"
-                 })
+    # 4. Build every view from one batched pivot of this subject's grades
+    df_display = build_gradebook(s, yr, roster, q)
 
     # 5. Display Table & Styles
-    if data:
-        df_display = pd.DataFrame(data)
+    if not df_display.empty:
         
         # --- STYLING ---
         def highlight_fail(val, limit):
@@ -1739,22 +3330,26 @@ def page_gradebook():
         st.info("No data to display.")
     
     # 6. Export to Excel
-    if data:
-        # Just use the display dataframe for export, renaming ID for clarity
-        df_export = df_display.copy()
-        if "ID" in df_export.columns:
-            df_export.rename(columns={"ID": "Student ID", "No": "No."}, inplace=True)
-            
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            df_export.to_excel(writer, index=False, sheet_name="Gradebook")
-            
-        st.download_button(
-            label="⬇️ Download Excel",
-            data=buffer.getvalue(),
-            file_name=f"Gradebook_{s}_{l}_{r}_{q}_{yr}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+    if not df_display.empty:
+        # The display dataframe is exported as is, with ID renamed for clarity
+        export_names = {"ID": "Student ID", "No": "No."}
+        def gradebook_sheet(name, df):
+            sheet, header, rows = frame_sheet(name, df)
+            return sheet, [export_names.get(h, h) for h in header], rows
+
+        c_one, c_all = st.columns(2)
+        with c_one:
+            path = export_workbook(("gradebook", s, yr, q, l, r), ["GradeSummary", "Students"], lambda: [gradebook_sheet("Gradebook", df_display)])
+            download_workbook("⬇️ Download Excel", path, f"Gradebook_{s}_{l}_{r}_{q}_{yr}.xlsx")
+        with c_all:
+            # One sheet per room of this level; each room's gradebook is built only when its sheet is written
+            def level_sheets():
+                for room in [str(i) for i in range(1, 16)]:
+                    room_roster = get_class_roster(l, room, only_active=True)
+                    if not room_roster.empty: yield gradebook_sheet(f"{l}-{room}", build_gradebook(s, yr, room_roster, q))
+            # Fifteen rosters and gradebooks: built on click, not on every render.
+            download_workbook(f"⬇️ Download All {l} Rooms", lambda: export_workbook(("gradebook-level", s, yr, q, l), ["GradeSummary", "Students"], level_sheets),
+                              f"Gradebook_{s}_{l}_{q}_{yr}.xlsx", key="dl_level")
 
 def page_student_dashboard():
     # --- HEADER ---
@@ -1770,42 +3365,15 @@ def page_student_dashboard():
     
     st.markdown(f"**Welcome, {st.session_state.user[1]}**")
 
-    # 2. Fetch Attendance Data
-    all_att = fetch_all_records("Attendance")
-    
-    # --- HELPER: Smart Column Finder ---
-    def get_col_value(row, targets):
-        keys = list(row.keys())
-        # 1. Exact match
-        for t in targets:
-            if t in row: return row[t]
-        # 2. Case-insensitive match
-        for k in keys:
-            for t in targets:
-                if k.lower().strip() == t.lower().strip():
-                    return row[k]
-        return None
-
-    # 3. Filter Records for THIS Student
-    my_records = []
-    for r in all_att:
-        row_id_val = get_col_value(r, ["student_id", "Student ID", "Student_ID", "ID", "id"])
-        if row_id_val is not None:
-            db_id = str(row_id_val).strip().replace(".0", "")
-            if db_id == my_id:
-                my_records.append(r)
+    # 2. Fetch this student's Attendance rows only, archived years included
+    my_records = get_attendance_history(student_id=my_id)
 
     # --- MAIN DISPLAY ---
     if not my_records:
         st.info("👋 You have no attendance records yet. Check back after your first class!")
     else:
         # Get list of subjects
-        subjects_set = set()
-        for r in my_records:
-            s = get_col_value(r, ["subject", "Subject", "Subject Name"])
-            if s: subjects_set.add(s)
-        
-        my_subjects = sorted(list(subjects_set))
+        my_subjects = sorted({r['subject'] for r in my_records if r.get('subject')})
         
         if not my_subjects:
             st.error("⚠️ Error: Found your records, but the 'Subject' column is missing in the database.")
@@ -1816,11 +3384,7 @@ def page_student_dashboard():
                 selected_sub = st.selectbox("Select Subject", my_subjects)
             
             # Filter for this subject
-            sub_recs = []
-            for r in my_records:
-                s = get_col_value(r, ["subject", "Subject", "Subject Name"])
-                if s == selected_sub:
-                    sub_recs.append(r)
+            sub_recs = [r for r in my_records if r['subject'] == selected_sub]
             
             # Calculate Stats
             n_present = 0
@@ -1829,7 +3393,7 @@ def page_student_dashboard():
             total = len(sub_recs)
             
             for r in sub_recs:
-                st_val = str(get_col_value(r, ["status", "Status", "attendance"])).lower()
+                st_val = str(r.get('status', '')).lower()
                 if "present" in st_val: n_present += 1
                 elif "late" in st_val: n_late += 1
                 elif "absent" in st_val: n_absent += 1
@@ -1870,9 +3434,9 @@ def page_student_dashboard():
             table_data = []
             for r in sub_recs:
                 table_data.append({
-                    "Date": get_col_value(r, ["date", "Date", "day"]),
-                    "Status": get_col_value(r, ["status", "Status"]),
-                    "Teacher": get_col_value(r, ["recorded_by", "Teacher", "Recorded By"])
+                    "Date": r.get('date'),
+                    "Status": r.get('status'),
+                    "Teacher": r.get('recorded_by')
                 })
             
             df_show = pd.DataFrame(table_data)
@@ -1910,12 +3474,11 @@ def page_student_record_teacher_view():
         df_filtered = df.copy()
         
         if search_term:
-            mask = (
-                df['student_name'].astype(str).str.contains(search_term, case=False) | 
-                df['student_id'].astype(str).str.contains(search_term, case=False)
-            )
-            df_filtered = df[mask]
-            st.caption(f"Found {len(df_filtered)} matches for '{search_term}'")
+            # Ranked matches from the shared search index, best first
+            hits = search_students(search_term)
+            rank = {sid: i for i, sid in enumerate(hits)}
+            df_filtered = df[df['student_id'].astype(str).map(clean_id).isin(rank)].sort_values('student_id', key=lambda c: c.astype(str).map(clean_id).map(rank))
+            st.caption(f"Found {len(df_filtered)} matches for '{search_term}'" + (" (showing the best)" if len(hits) == STUDENT_SEARCH_LIMIT else ""))
         else:
             all_grades = ["All Grades"] + sorted(df['grade_level'].astype(str).unique().tolist())
             all_rooms = ["All Rooms"] + sorted(df['room'].astype(str).unique().tolist())
@@ -1931,7 +3494,7 @@ def page_student_record_teacher_view():
 
         # Student Selector
         df_filtered['display'] = df_filtered['student_name'] + " (" + df_filtered['student_id'].astype(str) + ")"
-        student_opts = sorted(df_filtered['display'].tolist())
+        student_opts = df_filtered['display'].tolist() if search_term else sorted(df_filtered['display'].tolist())
         
         idx = 0
         if len(student_opts) == 1: idx = 0
@@ -1948,10 +3511,7 @@ def page_student_record_teacher_view():
         col_img, col_info = st.columns([1, 3])
         
         with col_img:
-            img_data = base64_to_image(student_rec.get('photo', ''))
-            if img_data:
-                st.image(img_data, width=180, caption=f"ID: {sel_id}")
-            else:
+            if not show_photo(student_rec.get('photo', ''), THUMB_SIZES["lg"], 180, caption=f"ID: {sel_id}"):
                 st.markdown(
                     f"""<div style='width:180px; height:180px; background-color:#f0f2f6; 
                     border-radius:10px; display:flex; align-items:center; justify-content:center;
@@ -1969,8 +3529,7 @@ def page_student_record_teacher_view():
             
         # --- 4. GRADES TABLE WITH RED HIGHLIGHTS ---
         st.markdown("### 📚 Academic History")
-        all_grades = fetch_all_records("Grades")
-        student_grades = [g for g in all_grades if str(g['student_id']).strip().replace(".0","") == str(sel_id)]
+        student_grades = fetch_records("Grades", student_id=sel_id)
         
         if student_grades:
             df_g = pd.DataFrame(student_grades)
@@ -2013,13 +3572,18 @@ def page_student_record_teacher_view():
             
             st.dataframe(styled_df, use_container_width=True, hide_index=True)
 
+            # Report card per school year, same computation as the student portal
+            cards = get_report_cards(student_id=sel_id)
+            for yr in sorted(cards['school_year'].unique(), reverse=True):
+                with st.expander(f"📜 Report Card {yr}"):
+                    show_report_card(cards[cards['school_year'] == yr])
+
         else:
             st.caption("No grades recorded yet.")
             
         # --- 5. ATTENDANCE ---
         st.markdown("### 📅 Attendance Overview")
-        all_att = fetch_all_records("Attendance")
-        my_att = [r for r in all_att if str(r.get('student_id','')).strip().replace(".0","") == str(sel_id)]
+        my_att = get_attendance_history(student_id=sel_id)
         
         if my_att:
             df_a = pd.DataFrame(my_att)
@@ -2063,9 +3627,6 @@ def page_attendance():
     if not df_students.empty and 'class_no' in df_students.columns:
         df_students['class_no'] = pd.to_numeric(df_students['class_no'], errors='coerce').fillna(999).astype(int)
 
-    all_att = fetch_all_records("Attendance")
-    df_att = pd.DataFrame(all_att)
-
     if len(subjects) <= 1: 
         st.error("🚫 **System Error:** No subjects found. Please contact the administrator.")
         return
@@ -2127,10 +3688,8 @@ def page_attendance():
                 st.warning("⚠️ No students found in this Grade/Room.")
             else:
                 existing_map = {}
-                if not df_att.empty:
-                    day_records = df_att[(df_att['date'].astype(str) == str(date_val)) & (df_att['subject'] == selected_sub)]
-                    for _, r in day_records.iterrows():
-                        existing_map[str(r['student_id']).replace(".0","")] = r.get('status', 'Present')
+                for r in fetch_records("Attendance", subject=selected_sub, date=str(date_val)):
+                    existing_map[str(r['student_id']).replace(".0","")] = r.get('status', 'Present')
 
                 editor_rows = []
                 STATUS_OPTS = ["🟢 Present", "🔴 Absent", "🟡 Late", "⚪ Excused"]
@@ -2177,37 +3736,8 @@ def page_attendance():
                 
                 if st.button("💾 Save Attendance & Reset", type="primary", use_container_width=True):
                     try:
-                        teacher = st.session_state.user[0]
-                        timestamp = str(datetime.datetime.now())
-                        current_db = fetch_all_records("Attendance")
-                        
-                        ids_to_update = edited_df['Student_ID'].astype(str).tolist()
-                        
-                        final_list = []
-                        for r in current_db:
-                            is_same_day = (str(r.get('date')) == str(date_val))
-                            is_same_sub = (r.get('subject') == selected_sub)
-                            sid = str(r.get('student_id')).replace(".0","")
-                            
-                            if not (is_same_day and is_same_sub and sid in ids_to_update):
-                                final_list.append(r)
-                        
-                        for _, row in edited_df.iterrows():
-                            clean_stat = row['Status'].split(" ")[1] if " " in row['Status'] else row['Status']
-                            new_rec = {
-                                "uid": f"{date_val}_{selected_sub}_{row['Student_ID']}",
-                                "student_id": row['Student_ID'],
-                                "student_name": row['Name'],
-                                "subject": selected_sub,
-                                "date": str(date_val),
-                                "status": clean_stat,
-                                "recorded_by": teacher,
-                                "timestamp": timestamp
-                            }
-                            final_list.append(new_rec)
-                            
-                        overwrite_sheet_data("Attendance", final_list)
-                        st.success("✅ **Saved Successfully!** Resetting page...")
+                        n_saved = save_attendance_register(selected_sub, date_val, edited_df, df_edit, existing_map, st.session_state.user[0])
+                        st.success(f"✅ **Saved {n_saved} change(s)!** Resetting page..." if n_saved else "✅ **No changes to save.** Resetting page...")
                         reset_daily_filters()
                         if 'att_sub_daily' in st.session_state: del st.session_state.att_sub_daily
                         time.sleep(1)
@@ -2226,13 +3756,23 @@ def page_attendance():
             all_grades_rep = ["Select Grade..."] + sorted(df_students['grade_level'].unique().astype(str).tolist())
             all_rooms_rep = ["Select Room..."] + sorted(df_students['room'].unique().astype(str).tolist(), key=lambda x: int(x) if x.isdigit() else x)
             
-            rc1, rc2 = st.columns(2)
+            # Reporting periods: every live record, the running month or quarter, or one semester of a school year
+            today = datetime.date.today()
+            this_q = next(q for q in range(1, 5) if quarter_dates(get_school_years()[1], q)[1] >= today.isoformat())
+            periods = {"All Records": (None, None), "This Month": (today.replace(day=1).isoformat(), today.isoformat()),
+                       "This Quarter": (quarter_dates(get_school_years()[1], this_q)[0], today.isoformat())}
+            for sy in get_school_years()[:2]:
+                for term in (1, 2): periods[f"{sy} Semester {term}"] = term_dates(sy, term)
+
+            rc1, rc2, rc3 = st.columns(3)
             with rc1:
                 g_rep_disabled = (view_sub == "Select Subject...")
                 f_grade = st.selectbox("2️⃣ Filter Grade", all_grades_rep, key="rep_grade", disabled=g_rep_disabled)
             with rc2:
                 r_rep_disabled = (f_grade == "Select Grade...")
                 f_room = st.selectbox("3️⃣ Filter Room", all_rooms_rep, key="rep_room", disabled=r_rep_disabled)
+            with rc3:
+                f_period = st.selectbox("📆 Period", list(periods), key="rep_period")
 
         rep_ready = (view_sub != "Select Subject..." and f_grade != "Select Grade..." and f_room != "Select Room...")
 
@@ -2241,7 +3781,10 @@ def page_attendance():
                 st.session_state.report_generated = True
             
             if st.session_state.get('report_generated', False):
-                stats = get_attendance_score_data(view_sub)
+                # Only this class's rows in the chosen period are read
+                class_mask = (df_students['grade_level'].astype(str) == f_grade) & (df_students['room'].astype(str) == f_room)
+                class_ids = df_students.loc[class_mask, 'student_id'].astype(str).map(clean_id).tolist()
+                stats = get_attendance_score_data(view_sub, class_ids, *periods[f_period])
                 
                 if not stats.empty:
                     # FIX 4: Ensure we bring 'class_no' into the report logic
@@ -2288,6 +3831,27 @@ def page_attendance():
                 else:
                     st.info("No records found.")
     
+def save_attendance_register(subject, date_val, edited, loaded, recorded, teacher):
+    """Saves a daily register as a diff against what was loaded: only students whose status changed, and
+    students with no row for the day yet (their default status has never been stored). Returns the rows written."""
+    loaded_status = loaded.set_index('Student_ID')['Status'].reindex(edited['Student_ID']).values
+    todo = edited[(edited['Status'].values != loaded_status) | ~edited['Student_ID'].isin(list(recorded)).values]
+    if todo.empty: return 0
+    status = todo['Status'].astype(str)
+    rows = pd.DataFrame({
+        "uid": f"{date_val}_{subject}_" + todo['Student_ID'].astype(str),
+        "student_id": todo['Student_ID'],
+        "student_name": todo['Name'],
+        "subject": subject,
+        "date": str(date_val),
+        # "🟢 Present" -> "Present"
+        "status": status.str.split(" ").str[1].where(status.str.contains(" "), status),
+        "recorded_by": teacher,
+        "timestamp": str(datetime.datetime.now()),
+    })
+    upsert_records("Attendance", rows.to_dict('records'))
+    return len(rows)
+
 # --- HELPER: SAVE FUNCTION (Paste this OUTSIDE page_attendance) ---
 def save_attendance_to_grades(report_df, subject, quarter, year, target_test):
     """
@@ -2299,8 +3863,8 @@ def save_attendance_to_grades(report_df, subject, quarter, year, target_test):
     
     if not db_col: return
 
-    # 2. Fetch existing grades
-    all_grades = fetch_all_records("Grades")
+    # 2. Fetch existing grades for this subject/quarter/year
+    all_grades = fetch_records("Grades", subject=subject, quarter=quarter, school_year=year)
     teacher = st.session_state.user[0]
     timestamp = str(datetime.datetime.now())
     
@@ -2312,6 +3876,7 @@ def save_attendance_to_grades(report_df, subject, quarter, year, target_test):
     
     # Track which IDs we have processed
     processed_ids = []
+    changed_rows = []
     
     # A. Update existing rows
     for row in all_grades:
@@ -2324,23 +3889,20 @@ def save_attendance_to_grades(report_df, subject, quarter, year, target_test):
                 row[db_col] = float(score_map[sid])
                 
                 # Recalculate Total
-                t1 = float(row.get('test1', 0) or 0)
-                t2 = float(row.get('test2', 0) or 0)
-                t3 = float(row.get('test3', 0) or 0)
-                fin = float(row.get('final_score', 0) or 0)
-                row['total_score'] = t1 + t2 + t3 + fin
+                row['total_score'] = grade_total(row)
                 
                 row['recorded_by'] = teacher
                 row['timestamp'] = timestamp
                 
                 processed_ids.append(sid)
+                changed_rows.append(row)
                 updated_count += 1
     
     # B. Create NEW rows for students who don't have a grade row yet
     for sid, score in score_map.items():
         if sid not in processed_ids:
             new_row = {
-                "id": int(time.time()) + int(sid), # Unique ID
+                "id": new_row_id(), # Unique ID
                 "student_id": sid,
                 "subject": subject,
                 "quarter": quarter,
@@ -2352,14 +3914,14 @@ def save_attendance_to_grades(report_df, subject, quarter, year, target_test):
             }
             # Set the specific test score
             new_row[db_col] = float(score)
-            new_row['total_score'] = float(score)
+            new_row['total_score'] = grade_total(new_row)
             
-            all_grades.append(new_row)
+            changed_rows.append(new_row)
             updated_count += 1
             
     # 4. Save to Database
     with st.spinner("Saving scores to Gradebook..."):
-        overwrite_sheet_data("Grades", all_grades)
+        upsert_records("Grades", changed_rows)
         
     st.success(f"✅ Successfully exported scores for {updated_count} students to {target_test}!")
     time.sleep(2)
@@ -2369,20 +3931,19 @@ def save_attendance_to_grades(report_df, subject, quarter, year, target_test):
 def page_teacher_settings():
     st.title("⚙️ Settings")
     current_u = st.session_state.user[0]
-    current_p = st.session_state.user[1]
     
     with st.container():
         st.subheader("Security")
         with st.form("teach_settings"):
             new_u = st.text_input("Username", value=current_u)
-            new_p = st.text_input("Password", value=current_p, type="password")
+            new_p = st.text_input("New Password", type="password", placeholder="Leave blank to keep current password")
             if st.form_submit_button("Update Credentials"):
-                if new_u and new_p:
+                if new_u:
                     with st.spinner("Updating..."):
                         ok, msg = update_teacher_credentials(current_u, new_u, new_p)
                         if ok: st.success(msg); st.session_state.logged_in = False; time.sleep(2); st.rerun()
                         else: st.error(msg)
-                else: st.warning("Fields cannot be empty.")
+                else: st.warning("Username cannot be empty.")
 def page_student_portal_grades():
     s_data = st.session_state.user
     s_id = str(s_data[0]) # Ensure string format
@@ -2391,113 +3952,31 @@ def page_student_portal_grades():
     st.title(f"👋 Hello, {s_name}")
     st.caption(f"Student ID: {s_id}")
 
-    # --- HELPER: GPA SCALE ---
-    def get_sem_gpa(score):
-        if score >= 80: return 4.0
-        elif score >= 75: return 3.5
-        elif score >= 70: return 3.0
-        elif score >= 65: return 2.5
-        elif score >= 60: return 2.0
-        elif score >= 55: return 1.5
-        elif score >= 50: return 1.0
-        else: return 0.0
-
     # --- 1. REPORT CARD SECTION ---
     st.header("📜 Report Card")
     
-    # Fetch all grades
-    all_grades = fetch_all_records("Grades")
-    # Filter for this student
-    my_grades = [g for g in all_grades if clean_id(g['student_id']) == s_id]
+    # Fetch this student's grades
+    my_grades = fetch_records("Grades", student_id=s_id)
 
     if not my_grades:
         st.info("No academic records found.")
     else:
-        df_grades = pd.DataFrame(my_grades)
+        cards = get_report_cards(student_id=s_id)
         
         # Group by School Year (Newest first)
-        unique_years = sorted(df_grades['school_year'].unique(), reverse=True)
+        unique_years = sorted(cards['school_year'].unique(), reverse=True)
         
         for yr in unique_years:
             with st.container():
                 st.subheader(f"📅 School Year: {yr}")
+                year_cards = cards[cards['school_year'] == yr]
                 
-                # Filter for this year
-                year_data = df_grades[df_grades['school_year'] == yr]
-                subjects = year_data['subject'].unique()
-                
-                report_card_data = []
-                
-                for sub in subjects:
-                    # Get entries for this subject
-                    sub_entries = year_data[year_data['subject'] == sub]
-                    
-                    # Teacher Name (from most recent entry)
-                    teacher = sub_entries.iloc[0]['recorded_by'] if not sub_entries.empty else "-"
-
-                    # Extract Quarters
-                    def get_score(q_name):
-                        row = sub_entries[sub_entries['quarter'] == q_name]
-                        return float(row.iloc[0]['total_score']) if not row.empty else 0.0
-                    
-                    q1 = get_score("Q1")
-                    q2 = get_score("Q2")
-                    q3 = get_score("Q3")
-                    q4 = get_score("Q4")
-                    
-                    # Calculate Semesters
-                    sem1_total = q1 + q2
-                    sem1_gpa = get_sem_gpa(sem1_total)
-                    
-                    sem2_total = q3 + q4
-                    sem2_gpa = get_sem_gpa(sem2_total)
-                    
-                    report_card_data.append({
-                        "Subject": sub,
-                        "Teacher": teacher,
-                        "Q1": fmt_score(q1),
-                        "Q2": fmt_score(q2),
-                        "1st Sem Total": fmt_score(sem1_total),
-                        "1st Sem GPA": f"{sem1_gpa:.1f}",
-                        "Q3": fmt_score(q3),
-                        "Q4": fmt_score(q4),
-                        "2nd Sem Total": fmt_score(sem2_total),
-                        "2nd Sem GPA": f"{sem2_gpa:.1f}"
-                    })
-                
-                if report_card_data:
-                    df_display = pd.DataFrame(report_card_data)
-                    
-                    # Display Table
-                    st.dataframe(
-                        df_display,
-                        hide_index=True,
-                        use_container_width=True,
-                        column_config={
-                            "Subject": st.column_config.TextColumn("Subject", width="medium"),
-                            "Teacher": st.column_config.TextColumn("Teacher", width="small"),
-                            "Q1": st.column_config.TextColumn("Q1", width="small"),
-                            "Q2": st.column_config.TextColumn("Q2", width="small"),
-                            "1st Sem Total": st.column_config.TextColumn("Sem 1 Score", width="small", help="Sum of Q1 + Q2"),
-                            "1st Sem GPA": st.column_config.TextColumn("Sem 1 GPA", width="small"),
-                            "Q3": st.column_config.TextColumn("Q3", width="small"),
-                            "Q4": st.column_config.TextColumn("Q4", width="small"),
-                            "2nd Sem Total": st.column_config.TextColumn("Sem 2 Score", width="small", help="Sum of Q3 + Q4"),
-                            "2nd Sem GPA": st.column_config.TextColumn("Sem 2 GPA", width="small"),
-                        }
-                    )
+                if not year_cards.empty:
+                    df_display = show_report_card(year_cards)
                     
                     # DOWNLOAD BUTTON
-                    buffer = io.BytesIO()
-                    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                        df_display.to_excel(writer, index=False, sheet_name=f"Report_{yr}")
-                    
-                    st.download_button(
-                        label=f"⬇️ Download Report Card ({yr})",
-                        data=buffer.getvalue(),
-                        file_name=f"Report_Card_{s_name}_{yr}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
+                    path = export_workbook(("report", s_id, yr), ["GradeSummary"], lambda: [frame_sheet(f"Report_{yr}", df_display)])
+                    download_workbook(f"⬇️ Download Report Card ({yr})", path, f"Report_Card_{s_name}_{yr}.xlsx", key=f"dl_report_{yr}")
                 else:
                     st.caption("No grades recorded for this year.")
                 st.divider()
@@ -2505,14 +3984,12 @@ def page_student_portal_grades():
     # --- 2. TASK BREAKDOWN SECTION ---
     st.header("📊 Task Breakdown")
     
-    # Fetch all tasks
-    all_tasks = fetch_all_records("Tasks")
-    my_tasks = [t for t in all_tasks if clean_id(t['student_id']) == s_id]
+    # Fetch this student's tasks
+    df_tasks = get_student_task_totals(s_id)
     
-    if not my_tasks:
+    if df_tasks.empty:
         st.info("No detailed tasks found.")
     else:
-        df_tasks = pd.DataFrame(my_tasks)
         
         # Group by School Year
         task_years = sorted(df_tasks['school_year'].unique(), reverse=True)
@@ -2575,6 +4052,8 @@ else:
         if sel == "Dashboard": page_admin_dashboard()
         elif sel == "👥 Manage Teachers": page_admin_manage_teachers()
         elif sel == "🎓 Manage Students": page_admin_manage_students()
+        elif sel == "📑 Report Cards": page_admin_report_cards()
+        elif sel == "⚖️ Grading Scale": page_admin_grading_scale()
     elif st.session_state.role == "Teacher":
         if sel == "Dashboard": page_dashboard()
         elif sel == "📂 Student Roster": page_roster()